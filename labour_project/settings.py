@@ -245,6 +245,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.sessions',
     'django.contrib.gis',
+    'django.contrib.postgres',
     'django.contrib.staticfiles',
     'admin.apps.AdminConfig',
     'mapit_labour',
@@ -317,7 +318,9 @@ LOGIN_REQUIRED_IGNORE_PATHS = [
 
 API_KEY_AUTH_ALLOWED_PATHS = [
     r'^/uprn/\d+(\.json)?$',
+    r'^/uprns$',
     r'^/addressbase$',
+    r'^/addressbase/autocomplete$',
 
     # Standard MapIt API URL prefixes
     r'^/generations',
@@ -332,6 +335,28 @@ API_KEY_AUTH_ALLOWED_PATHS = [
 
 ADDRESSBASE_RESULTS_LIMIT = config.get('ADDRESSBASE_RESULTS_LIMIT', 100)
 
+# Maximum number of results from /addressbase when they're streamed
+ADDRESSBASE_STREAMING_RESULTS_LIMIT = config.get('ADDRESSBASE_STREAMING_RESULTS_LIMIT', 100000)
+
+# Number of suggestions returned by /addressbase/autocomplete, the shortest
+# prefix it makes suggestions for, how long (in seconds) the suggestions for
+# each prefix are cached, and the max-age of its responses (which can't be
+# invalidated by imports, so should be short)
+AUTOCOMPLETE_LIMIT = config.get('AUTOCOMPLETE_LIMIT', 10)
+AUTOCOMPLETE_MIN_LENGTH = config.get('AUTOCOMPLETE_MIN_LENGTH', 3)
+AUTOCOMPLETE_CACHE_TIMEOUT = config.get('AUTOCOMPLETE_CACHE_TIMEOUT', 86400)
+AUTOCOMPLETE_MAX_AGE = config.get('AUTOCOMPLETE_MAX_AGE', 300)
+
+UPRN_BATCH_LIMIT = config.get('UPRN_BATCH_LIMIT', 10000)
+
+# Default and maximum number of UPRNs returned by the nearest UPRNs API call
+NEAREST_UPRNS_DEFAULT = 10
+NEAREST_UPRNS_LIMIT = config.get('NEAREST_UPRNS_LIMIT', 100)
+
+# Number of rows fetched from the database (and written out) at a time
+# by streaming responses
+STREAMING_CHUNK_SIZE = 2000
+
 Q_CLUSTER = {
     'name': 'mapit_labour',
     'workers': 1,
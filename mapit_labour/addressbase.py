@@ -0,0 +1,176 @@
+"""
+Conversion between AddressBase Core records and the way they're stored.
+
+The most used fields of a record are stored in typed columns on UPRN, and
+the rest in its addressbase_extra JSONB column, leaving out empty fields.
+A field is only left to its column if the column's value converts back to
+exactly the original string, otherwise the original is kept in
+addressbase_extra too, so build_record always returns the record that was
+imported. Its keys are in the order PostgreSQL's JSONB type uses, so the
+output is the same as when whole records were stored as JSONB.
+"""
+
+import re
+from datetime import date
+
+# Every field of an AddressBase Core record, as in the CSV header
+FIELDS = [
+    "uprn",
+    "parent_uprn",
+    "udprn",
+    "usrn",
+    "toid",
+    "classification_code",
+    "easting",
+    "northing",
+    "latitude",
+    "longitude",
+    "rpc",
+    "last_update_date",
+    "single_line_address",
+    "po_box",
+    "organisation",
+    "sub_building",
+    "building_name",
+    "building_number",
+    "street_name",
+    "locality",
+    "town_name",
+    "post_town",
+    "island",
+    "postcode",
+    "delivery_point_suffix",
+    "gss_code",
+    "change_code",
+]
+
+
+def to_int(value):
+    if re.fullmatch(r"0|[1-9][0-9]{0,17}", value):
+        return int(value)
+    return None
+
+
+def from_int(value):
+    return "" if value is None else str(value)
+
+
+def to_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def from_date(value):
+    return "" if value is None else value.isoformat()
+
+
+def normalise_postcode(value):
+    return value.replace(" ", "")
+
+
+def format_postcode(value):
+    return f"{value[:-3]} {value[-3:]}" if len(value) > 3 else value
+
+
+def identity(value):
+    return value
+
+
+# Fields stored in columns of the same name, with functions to convert a
+# field value to the column value and back
+COLUMNS = {
+    "uprn": (to_int, from_int),
+    "parent_uprn": (to_int, from_int),
+    "udprn": (to_int, from_int),
+    "usrn": (to_int, from_int),
+    "toid": (identity, identity),
+    "classification_code": (identity, identity),
+    "last_update_date": (to_date, from_date),
+    "single_line_address": (identity, identity),
+    "postcode": (normalise_postcode, format_postcode),
+}
+
+# The SQL for the text of each column field of a mapit_labour_uprn row
+COLUMN_SQL = {
+    "uprn": "mapit_labour_uprn.uprn::text",
+    "parent_uprn": "COALESCE(mapit_labour_uprn.parent_uprn::text, '')",
+    "udprn": "COALESCE(mapit_labour_uprn.udprn::text, '')",
+    "usrn": "COALESCE(mapit_labour_uprn.usrn::text, '')",
+    "toid": "mapit_labour_uprn.toid",
+    "classification_code": "mapit_labour_uprn.classification_code",
+    "last_update_date": (
+        "COALESCE(to_char(mapit_labour_uprn.last_update_date, 'YYYY-MM-DD'), '')"
+    ),
+    "single_line_address": "mapit_labour_uprn.single_line_address",
+    "postcode": (
+        "CASE WHEN length(mapit_labour_uprn.postcode) > 3 "
+        "THEN left(mapit_labour_uprn.postcode, -3) || ' ' || right(mapit_labour_uprn.postcode, 3) "
+        "ELSE mapit_labour_uprn.postcode END"
+    ),
+}
+
+# The SQL for the record of a mapit_labour_uprn row as JSON text, the same
+# as encoding build_record's output: jsonb_build_object and || give keys in
+# the same order, and PostgreSQL escapes strings the same way as Python's
+# json module does with ensure_ascii=False.
+RECORD_SQL = "(jsonb_build_object(%s) || mapit_labour_uprn.addressbase_extra)::text" % (
+    ", ".join(f"'{field}', " + COLUMN_SQL.get(field, "''") for field in FIELDS)
+)
+
+# The UPRN columns a record is built from, in the order record_from_values
+# expects them
+STORED_COLUMNS = [*COLUMNS, "addressbase_extra"]
+
+
+def jsonb_key_order(key):
+    """Sort key giving the order of the keys of a JSONB object."""
+    key = key.encode()
+    return (len(key), key)
+
+
+def split_record(record):
+    """
+    Split an AddressBase Core record (with lower case field names) into a
+    dict of column values and a dict of the fields to store in
+    addressbase_extra.
+    """
+    columns = {}
+    extra = {}
+    for field, value in record.items():
+        if field in COLUMNS:
+            to_column, from_column = COLUMNS[field]
+            columns[field] = to_column(value)
+            if from_column(columns[field]) != value:
+                extra[field] = value
+        elif value or field not in FIELDS:
+            extra[field] = value
+    for field, (to_column, _) in COLUMNS.items():
+        columns.setdefault(field, to_column(""))
+    return columns, extra
+
+
+def build_record(columns, extra):
+    """The AddressBase Core record stored as columns and extra."""
+    record = dict.fromkeys(FIELDS, "")
+    for field, (_, from_column) in COLUMNS.items():
+        record[field] = from_column(columns[field])
+    record.update(extra)
+    return {key: record[key] for key in sorted(record, key=jsonb_key_order)}
+
+
+def record_from_values(values):
+    """build_record for a sequence of the values of STORED_COLUMNS."""
+    return build_record(dict(zip(COLUMNS, values)), values[-1])
+
+
+def field_sql(field):
+    """
+    SQL for the text of field in the record of a mapit_labour_uprn row,
+    taking the key of addressbase_extra as a parameter.
+    """
+    extra = "mapit_labour_uprn.addressbase_extra ->> %s"
+    if field in COLUMN_SQL:
+        return f"COALESCE({extra}, {COLUMN_SQL[field]})"
+    return f"COALESCE({extra}, '')"
@@ -10,6 +10,7 @@ from django.forms import widgets
 from django.core.paginator import Paginator
 from django.utils.functional import cached_property
 from django.urls import reverse
+from django.utils.html import format_html
 
 
 from mapit_labour.models import UPRN, APIKey
@@ -57,13 +58,17 @@ class LargeTablePaginator(Paginator):
         Warning: PostgreSQL only hack
         Overrides the count method of QuerySet objects to get an estimate instead of actual count when not filtered.
         However, this estimate can be stale and hence not fit for situations where the count of objects actually matter.
+        For a partitioned table it's the sum of its leaf partitions' estimates, as the
+        parent's own estimate (from ANALYZE on PostgreSQL 14+) would count every row twice.
         """
         query = self.object_list.query
         if not query.where:
             try:
                 cursor = connection.cursor()
                 cursor.execute(
-                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    "SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0) "
+                    "FROM pg_partition_tree(%s::regclass) t "
+                    "JOIN pg_class c ON c.oid = t.relid WHERE t.isleaf",
                     [query.model._meta.db_table],
                 )
                 return int(cursor.fetchone()[0])
@@ -103,6 +108,11 @@ class UPRNAdmin(OSMHTTPSGeoAdmin):
     show_full_result_count = False
     paginator = LargeTablePaginator
     modifiable = False
+    readonly_fields = ["addressbase_core"]
+
+    @admin.display(description="AddressBase Core record")
+    def addressbase_core(self, obj):
+        return format_html("<pre>{}</pre>", json.dumps(obj.addressbase, indent=2))
 
     def get_search_results(self, request, queryset, search_term):
         if search_term:
@@ -0,0 +1,181 @@
+"""
+Caching of UPRN lookup responses in the Django cache.
+
+Cache keys include version tokens that are replaced whenever the data a
+response was built from may have changed, so stale entries are never
+looked up again and just expire:
+
+- a per-UPRN token, changed by the AddressBase importer for each UPRN it
+  updates;
+- an AddressBase token, changed whenever any UPRN is created or updated;
+- a global token, changed by branch imports, generation changes and
+  AddressBase purges (before and after the import, instead of any
+  per-UPRN tokens).
+
+Tokens are the time (in nanoseconds since the epoch) they were set, so
+they can also be used as modification times. They expire eventually, as
+a missing token is just replaced by a new one, which is always safe.
+"""
+
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+GLOBAL_VERSION_KEY = "mapit_labour:version"
+ADDRESSBASE_VERSION_KEY = "mapit_labour:addressbase-version"
+UPRN_VERSION_KEY = "mapit_labour:uprn-version:%s"
+UPRN_RESPONSE_KEY = "mapit_labour:uprn:%s:%s:%s:%s:%s"
+AUTOCOMPLETE_KEY = "mapit_labour:autocomplete:%s:%s:%s"
+
+# How long version tokens are kept. Longer than cached responses last, so
+# tokens expiring doesn't usually cause extra cache misses.
+VERSION_TIMEOUT = 7 * 86400
+
+# Query parameters that don't affect the content of a response
+IGNORED_PARAMS = {"api_key", "callback"}
+
+
+def _new_token():
+    return time.time_ns()
+
+
+def get_versions(*keys):
+    """
+    Return the current tokens for the given version keys, setting a new
+    token for any that aren't in the cache (e.g. after being evicted).
+    """
+    versions = cache.get_many(keys)
+    if missing := {k: _new_token() for k in keys if k not in versions}:
+        cache.set_many(missing, timeout=VERSION_TIMEOUT)
+        versions.update(missing)
+    return [versions[k] for k in keys]
+
+
+def invalidate_all():
+    cache.set(GLOBAL_VERSION_KEY, _new_token(), timeout=VERSION_TIMEOUT)
+
+
+def invalidate_uprns(uprns):
+    """
+    Invalidate lookups of the given existing UPRNs, and any AddressBase
+    queries. New UPRNs need only the latter, as nothing can be cached for
+    a UPRN before it exists.
+    """
+    token = _new_token()
+    versions = {UPRN_VERSION_KEY % uprn: token for uprn in uprns}
+    versions[ADDRESSBASE_VERSION_KEY] = token
+    cache.set_many(versions, timeout=VERSION_TIMEOUT)
+
+
+def token_time(token):
+    return datetime.fromtimestamp(token / 1e9, tz=timezone.utc)
+
+
+def query_hash(request):
+    """A hash of the query parameters of request that affect its response."""
+    params = sorted((k, v) for k, v in request.GET.lists() if k not in IGNORED_PARAMS)
+    return hashlib.md5(repr(params).encode()).hexdigest()
+
+
+def uprn_response_key(request, uprn, generation, versions):
+    """
+    The cache key for a UPRN lookup, given the global and UPRN version
+    tokens, or None if the response shouldn't be cached. In DEBUG mode
+    output_json adds the queries run to the output, so those responses are
+    never cached.
+    """
+    if settings.DEBUG:
+        return None
+    query = query_hash(request)
+    global_version, uprn_version = versions
+    return UPRN_RESPONSE_KEY % (
+        uprn,
+        generation,
+        global_version,
+        uprn_version,
+        query,
+    )
+
+
+def autocomplete_key(q):
+    """The cache key for the address suggestions for the prefix q."""
+    global_version, addressbase_version = get_versions(
+        GLOBAL_VERSION_KEY, ADDRESSBASE_VERSION_KEY
+    )
+    return AUTOCOMPLETE_KEY % (
+        global_version,
+        addressbase_version,
+        hashlib.md5(q.encode()).hexdigest(),
+    )
+
+
+def _build_response(content, headers):
+    response = HttpResponse(content)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+def get_cached_response(key):
+    if key is None:
+        return None
+    if cached := cache.get(key):
+        return _build_response(*cached)
+    return None
+
+
+def cache_response(key, response):
+    """
+    Store response in the cache under key, returning a response that can
+    be sent in its place (as a streaming response can only be read once).
+    """
+    if key is None or response.status_code != 200:
+        return response
+    if response.streaming:
+        content = b"".join(response.streaming_content)
+    else:
+        content = response.content
+    headers = list(response.items())
+    cache.set(key, (content, headers))
+    return _build_response(content, headers)
+
+
+class AreaCache:
+    """
+    Cache of serialised areas (the output of Area.as_dict()) for a single
+    request, as the same few areas recur across the UPRNs of batch and
+    postcode lookups. Areas are loaded lazily with load, a function taking a
+    list of area IDs and returning an iterable of areas. It isn't kept
+    between requests, as areas can change without any version token being
+    replaced, and a response that isn't in the response cache should always
+    be built from the current data.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.areas = {}
+        self.sort_keys = {}
+
+    def get_many(self, ids):
+        """
+        Return the serialised areas with the given IDs, skipping any that
+        don't exist, in Area's default ordering (by name, then type).
+        """
+        ids = set(ids)
+        if missing := [id for id in ids if id not in self.areas]:
+            loaded = {}
+            for area in self.load(missing):
+                loaded[area.id] = area.as_dict()
+                self.sort_keys[area.id] = (area.name, area.type_id)
+            for id in missing:
+                # Remember areas that don't exist too, so they aren't looked up again
+                self.areas[id] = loaded.get(id)
+        ids = sorted(
+            (id for id in ids if self.areas[id] is not None),
+            key=self.sort_keys.__getitem__,
+        )
+        return [self.areas[id] for id in ids]
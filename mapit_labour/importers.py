@@ -5,7 +5,8 @@ from django.contrib.gis.geos import MultiPolygon
 
 from mapit.models import Area, Type, CodeType, Generation
 
-from .models import CSVImportTaskProgress
+from .cache import invalidate_all
+from .models import CSVImportTaskProgress, UPRNAssignment
 
 REQUIRED_CSV_FIELDS = {
     "area_type",
@@ -31,6 +32,7 @@ class BranchCSVImporter:
     updated = 0
     warnings = None
     error = None
+    changed_areas = None
 
     progress = None
 
@@ -66,6 +68,7 @@ class BranchCSVImporter:
                 pass
 
         self.warnings = []
+        self.changed_areas = set()
 
     @classmethod
     def import_from_csv(
@@ -96,18 +99,23 @@ class BranchCSVImporter:
     @transaction.atomic
     def do_import(self):
         if self.purge:
-            Area.objects.filter(type__code__in=VALID_CODES).delete()
+            areas = Area.objects.filter(type__code__in=VALID_CODES)
+            self.changed_areas.update(areas.values_list("id", flat=True))
+            areas.delete()
 
         try:
             with open(self.path, encoding="utf-8-sig") as f:
                 reader = DictReader(f)
                 self.validate_fieldnames(reader.fieldnames)
                 self.handle_rows(reader)
+            self.update_assignments()
         except Exception as e:
             self.error = str(e)
 
         if not self.commit:
             transaction.set_rollback(True)
+        else:
+            transaction.on_commit(invalidate_all)
 
     def update_progress(self, msg):
         if not self.progress:
@@ -119,6 +127,13 @@ class BranchCSVImporter:
         # won't be persisted.
         self.progress.save(using="logging")
 
+    def update_assignments(self):
+        if not self.changed_areas or not self.generation:
+            return
+
+        self.update_progress("Updating UPRN area assignments")
+        UPRNAssignment.objects.refresh(self.generation, areas=self.changed_areas)
+
     def validate_fieldnames(self, fieldnames):
         if not set(fieldnames) >= REQUIRED_CSV_FIELDS:
             raise Exception(
@@ -221,6 +236,7 @@ class BranchCSVImporter:
                 self.created += 1
                 created_area_for_branch = True
 
+            self.changed_areas.add(a.id)
             a.codes.update_or_create(
                 type=gss_codetype, defaults={"code": branch["area_gss"]}
             )
@@ -0,0 +1,269 @@
+import csv
+import io
+import itertools
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Max, Min
+
+from mapit.shortcuts import output_json as mapit_output_json
+
+from mapit_labour.addressbase import FIELDS as ADDRESSBASE_FIELDS
+from mapit_labour.management.commands.mapit_labour_import_addressbase_core import (
+    BatchEncoder,
+)
+from mapit_labour.models import UPRN, UPRNAssignment
+from mapit_labour.shortcuts import output_json
+
+
+def timed(fn, repeat):
+    """Run fn repeat times, returning the median time taken in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks UPRN and AddressBase queries against the current database. "
+        "Results are only meaningful on a realistically sized table, e.g. after "
+        "importing a full AddressBase Core file"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "benchmarks",
+            nargs="*",
+            help="Benchmarks to run. Default is all of them",
+        )
+        parser.add_argument(
+            "--samples",
+            type=int,
+            default=20,
+            help="Number of UPRNs to sample query values from",
+        )
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=2000000,
+            help="Number of synthetic AddressBase rows for the import_encoding benchmark",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times to run each query",
+        )
+
+    def handle(self, **options):
+        benchmarks = {
+            "addressbase_lookup": self.benchmark_addressbase_lookup,
+            "import_encoding": self.benchmark_import_encoding,
+            "area_buffers": self.benchmark_area_buffers,
+            "records": self.benchmark_records,
+            "serialisation": self.benchmark_serialisation,
+            "json_output": self.benchmark_json_output,
+            "storage": self.benchmark_storage,
+        }
+        names = options["benchmarks"] or list(benchmarks)
+        if unknown := set(names) - set(benchmarks):
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        self.samples = self.sample_uprns(options["samples"])
+        if not self.samples:
+            raise CommandError("There are no UPRNs to benchmark against")
+        self.repeat = options["repeat"]
+        self.rows = options["rows"]
+
+        for name in names:
+            self.stdout.write(f"{name}:")
+            benchmarks[name]()
+
+    def sample_uprns(self, count):
+        """Pick count UPRNs spread across the table without a full scan."""
+        bounds = UPRN.objects.aggregate(low=Min("uprn"), high=Max("uprn"))
+        if bounds["low"] is None:
+            return []
+        samples = {}
+        for _ in range(count * 2):
+            uprn = (
+                UPRN.objects.filter(
+                    uprn__gte=random.randint(bounds["low"], bounds["high"])
+                )
+                .order_by("uprn")
+                .first()
+            )
+            if uprn:
+                samples[uprn.uprn] = uprn
+            if len(samples) >= count:
+                break
+        return list(samples.values())
+
+    def report(self, label, *values):
+        self.stdout.write(f"  {label:<24}" + "".join(f"{v:>14}" for v in values))
+
+    def benchmark_addressbase_lookup(self):
+        """Time AddressBase lookups on each of the most queried fields."""
+        self.report("field", "per lookup")
+        for field in ["uprn", "postcode", "usrn", "parent_uprn", "toid", "street_name"]:
+            lookups = [
+                {field: uprn.addressbase[field]}
+                for uprn in self.samples
+                if uprn.addressbase.get(field)
+            ]
+            if not lookups:
+                continue
+
+            def lookup_all():
+                for lookup in lookups:
+                    list(UPRN.objects.addressbase_lookup(lookup).values_list("uprn"))
+
+            self.report(field, f"{timed(lookup_all, self.repeat) / len(lookups):.2f}ms")
+
+    def benchmark_import_encoding(self, batch_size=1000):
+        """
+        Report the rate the AddressBase importer parses and encodes rows for
+        COPY, without the database, over synthetic rows based on the
+        sampled UPRNs, to compare with the rate of a real import.
+        """
+        f = io.StringIO()
+        w = csv.writer(f)
+        for uprn in self.samples:
+            w.writerow(uprn.addressbase.get(field, "") for field in ADDRESSBASE_FIELDS)
+        lines = f.getvalue().splitlines(keepends=True)
+        lines = itertools.islice(itertools.cycle(lines), self.rows)
+        reader = csv.DictReader(lines, ADDRESSBASE_FIELDS)
+
+        encoder = BatchEncoder()
+        parse_time = encode_time = 0
+        count = 0
+        while True:
+            start = time.perf_counter()
+            rows = list(itertools.islice(reader, batch_size))
+            parse_time += time.perf_counter() - start
+            if not rows:
+                break
+            start = time.perf_counter()
+            encoder.encode(rows)
+            encode_time += time.perf_counter() - start
+            count += len(rows)
+
+        self.report("stage", "rows/s")
+        self.report("parse", f"{count / max(parse_time, 1e-9):.0f}")
+        self.report("encode", f"{count / max(encode_time, 1e-9):.0f}")
+        self.report("total", f"{count / max(parse_time + encode_time, 1e-9):.0f}")
+
+    def benchmark_area_buffers(self):
+        """
+        Report the pages read to fetch every UPRN in the areas containing the
+        sampled UPRNs, e.g. to compare before and after an import --cluster.
+        """
+        areas = set()
+        for ids in UPRNAssignment.objects.filter(
+            uprn__in=[uprn.uprn for uprn in self.samples]
+        ).values_list("areas", flat=True):
+            areas.update(ids)
+        self.report("area", "rows", "pages", "pages/row")
+        total_rows = total_pages = 0
+        for area_id in sorted(areas):
+            plan = json.loads(
+                UPRN.objects.within_area(area_id)
+                .values_list("uprn", "single_line_address")
+                .explain(analyze=True, buffers=True, format="json")
+            )[0]["Plan"]
+            rows = plan["Actual Rows"]
+            pages = plan["Shared Hit Blocks"] + plan["Shared Read Blocks"]
+            total_rows += rows
+            total_pages += pages
+            self.report(area_id, rows, pages, f"{pages / max(rows, 1):.2f}")
+        self.report(
+            "total", total_rows, total_pages, f"{total_pages / max(total_rows, 1):.2f}"
+        )
+
+    def benchmark_records(self):
+        """Time fetching and building whole AddressBase records, as on a cache miss."""
+        uprns = [uprn.uprn for uprn in self.samples]
+
+        def fetch():
+            for uprn in UPRN.objects.filter(uprn__in=uprns):
+                uprn.as_dict()
+
+        self.report("records", f"{timed(fetch, self.repeat) / len(uprns):.3f}ms")
+
+    def benchmark_serialisation(self, count=1000):
+        """
+        Compare the rate UPRNs are fetched and encoded as JSON through model
+        instances against UPRNQuerySet.rows().
+        """
+        uprns = UPRN.objects.filter(uprn__gte=self.samples[0].uprn)[:count]
+        rows = len(uprns)
+        encoder = DjangoJSONEncoder()
+
+        def models():
+            for uprn in uprns.all():
+                encoder.encode(uprn.as_dict())
+
+        def fast():
+            for uprn in uprns.rows():
+                encoder.encode(uprn.as_dict())
+
+        self.report("path", "rows/s")
+        model_rate = rows / timed(models, self.repeat) * 1000
+        fast_rate = rows / timed(fast, self.repeat) * 1000
+        self.report("model", f"{model_rate:.0f}")
+        self.report("rows", f"{fast_rate:.0f}")
+        self.report("speedup", f"{fast_rate / model_rate:.1f}x")
+
+    def benchmark_json_output(self, count=1000):
+        """
+        Compare the time to output UPRNs as JSON with mapit's output_json,
+        from decoded records, against splicing in the records PostgreSQL
+        encoded, and check the output is the same.
+        """
+        uprns = UPRN.objects.filter(uprn__gte=self.samples[0].uprn)[:count]
+
+        def content(response):
+            return b"".join(response)
+
+        def decoded():
+            return content(mapit_output_json([u.as_dict() for u in uprns.rows()]))
+
+        def spliced():
+            return content(output_json([u.as_dict() for u in uprns.rows(raw=True)]))
+
+        self.report("path", "per response")
+        self.report("decoded", f"{timed(decoded, self.repeat):.1f}ms")
+        self.report("spliced", f"{timed(spliced, self.repeat):.1f}ms")
+        self.report("identical", "yes" if decoded() == spliced() else "NO")
+
+    def benchmark_storage(self):
+        """
+        Report the size on disk of the UPRN table, its TOAST table and its
+        indexes, summed over its partitions.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT pg_size_pretty(SUM(pg_table_size(c.oid))), "
+            "pg_size_pretty(SUM(COALESCE(pg_relation_size(c.reltoastrelid), 0))), "
+            "pg_size_pretty(SUM(pg_indexes_size(c.oid))) "
+            "FROM pg_partition_tree('mapit_labour_uprn') t JOIN pg_class c ON c.oid = t.relid "
+            "WHERE t.isleaf"
+        )
+        self.report("", "table", "toast", "indexes")
+        self.report("mapit_labour_uprn", *cursor.fetchone())
+        cursor.execute(
+            "SELECT indexrelid::regclass::text, pg_size_pretty(size) FROM pg_index, "
+            "LATERAL (SELECT SUM(pg_relation_size(relid)) AS size FROM pg_partition_tree(indexrelid)) s "
+            "WHERE indrelid = 'mapit_labour_uprn'::regclass "
+            "ORDER BY size DESC"
+        )
+        for name, size in cursor.fetchall():
+            self.report(name, "", "", size)
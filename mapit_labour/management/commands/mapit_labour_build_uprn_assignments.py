@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mapit.models import Generation
+
+from mapit_labour.models import UPRNAssignment
+
+
+class Command(BaseCommand):
+    help = (
+        "(Re)builds the precomputed UPRN area assignments for a generation. "
+        "Run this after activating a generation, as its assignments are deleted "
+        "then and UPRN lookups use slower spatial queries until they're rebuilt"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--generation",
+            dest="generation",
+            type=int,
+            default=None,
+            help="Generation to build assignments for. Default is the current generation",
+        )
+
+    def handle(self, **options):
+        if options["generation"]:
+            try:
+                generation = Generation.objects.get(id=options["generation"])
+            except Generation.DoesNotExist:
+                raise CommandError("Invalid generation number specified")
+        else:
+            generation = Generation.objects.current()
+            if not generation:
+                raise CommandError("There is no current generation")
+
+        with transaction.atomic():
+            count = UPRNAssignment.objects.refresh(generation)
+        self.stdout.write(f"Assigned {count} UPRNs in generation {generation.id}")
@@ -1,4 +1,4 @@
-from itertools import groupby
+from functools import partial
 from collections import deque
 from contextlib import contextmanager
 import gzip
@@ -6,17 +6,28 @@ import bz2
 import codecs
 import io
 import json
+import multiprocessing
+import queue
+import struct
 import sys
 import time
+import traceback
 
 from django.conf import settings
-from django.core.management.base import LabelCommand
-from django.db import transaction, connection
+from django.core.cache import caches
+from django.core.management.base import CommandError, LabelCommand
+from django.db import transaction, connection, connections
 
-from csv import DictReader, writer
+from csv import DictReader
+from datetime import date
 
 
-from mapit_labour.models import UPRN
+from mapit.models import Generation
+
+from mapit_labour.addressbase import split_record
+from mapit_labour.cache import invalidate_all, invalidate_uprns
+from mapit_labour.models import UPRN, UPRNAssignment
+from mapit_labour.utils import batched
 
 if settings.DEBUG:
     # Disable the Django SQL query log, which eats memory.
@@ -26,16 +37,6 @@ if settings.DEBUG:
     connection.queries_log = deque(maxlen=0)  # pragma: no cover
 
 
-def batched(iterable, size):
-    """
-    Split an iterable into smaller iterables no bigger than size
-    """
-    return (
-        (g for _, g in item)
-        for _, item in groupby(enumerate(iterable), key=lambda x: x[0] // size)
-    )
-
-
 @contextmanager
 def open_compressed_maybe(path, **kwargs):
     """
@@ -57,54 +58,138 @@ def open_compressed_maybe(path, **kwargs):
         yield f
 
 
-# From https://stackoverflow.com/a/20260030
-def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
-    """
-    Lets you use an iterable (e.g. a generator) that yields bytestrings as a read-only
-    input stream. For efficiency, the stream is buffered.
-    """
+def filter_old_rows(csv, cutoff):
+    for row in csv:
+        if row["last_update_date"] > cutoff:
+            yield row
 
-    class IterStream(io.RawIOBase):
-        def __init__(self):
-            self.leftover = None
 
-        def readable(self):
-            return True
+# Encoders of values in PostgreSQL's binary COPY format, each a field's
+# length followed by its value, or a length of -1 for NULL
+INT4 = struct.Struct("!i")
+INT8_FIELD = struct.Struct("!iq")
+DATE_FIELD = struct.Struct("!ii")
+JSONB_FIELD = struct.Struct("!iB")
+NULL_FIELD = INT4.pack(-1)
+POSTGRES_EPOCH = date(2000, 1, 1).toordinal()
+JSONB_VERSION = 1
 
-        def readinto(self, b):
-            try:
-                ll = len(b)  # We're supposed to return at most this much
-                chunk = self.leftover or next(iterable)
-                output, self.leftover = chunk[:ll], chunk[ll:]
-                b[: len(output)] = output
-                return len(output)
-            except StopIteration:
-                return 0  # indicate EOF
 
-    return io.BufferedReader(IterStream(), buffer_size=buffer_size)
+def encode_text(value):
+    value = value.encode()
+    return INT4.pack(len(value)) + value
 
 
-def filter_old_rows(csv, cutoff):
-    for row in csv:
-        if row["LAST_UPDATE_DATE"] > cutoff:
-            yield row
+def encode_int8(value):
+    return NULL_FIELD if value is None else INT8_FIELD.pack(8, value)
+
+
+def encode_date(value):
+    if value is None:
+        return NULL_FIELD
+    return DATE_FIELD.pack(4, value.toordinal() - POSTGRES_EPOCH)
+
+
+def encode_jsonb(value):
+    value = value.encode()
+    return JSONB_FIELD.pack(len(value) + 1, JSONB_VERSION) + value
+
+
+# The columns of mapit_labour_uprn an AddressBase record is stored in,
+# other than uprn and location, and how to encode them for COPY
+RECORD_COLUMNS = {
+    "postcode": encode_text,
+    "single_line_address": encode_text,
+    "usrn": encode_int8,
+    "parent_uprn": encode_int8,
+    "udprn": encode_int8,
+    "toid": encode_text,
+    "classification_code": encode_text,
+    "last_update_date": encode_date,
+    "addressbase_extra": encode_jsonb,
+}
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+# The number of fields in a row, and the uprn and the length of location
+ROW_START = struct.Struct("!hiqi")
+ROW_FIELDS = 2 + len(RECORD_COLUMNS)
+# A location as little endian EWKB: a point, with an SRID
+EWKB_POINT = struct.Struct("<BIIdd")
+EWKB_POINT_TYPE = 0x20000001
+SRID = 27700
+
+
+def import_worker(command, tasks, results):
+    """
+    Run in a separate process by Command.import_parallel: import each batch
+    of rows put on tasks until None is, with the process's own connection
+    and staging table, putting the counts for each batch on results. None
+    is put on results when done, or the traceback if anything goes wrong.
+    """
+    try:
+        command.create_staging_table()
+        for rows in iter(tasks.get, None):
+            command.count = dict.fromkeys(command.count, 0)
+            command.handle_rows(rows)
+            results.put(command.count)
+        command.drop_staging_table()
+        results.put(None)
+    except Exception:
+        results.put(traceback.format_exc())
+    finally:
+        connection.close()
+
+
+# SQL for the key UPRNs are physically ordered by: the geohash of their
+# location, which is a Z-order (Morton) curve, so UPRNs near each other are
+# mostly on the same or neighbouring pages. It's immutable, so it can be
+# indexed.
+CLUSTER_KEY_SQL = "ST_GeoHash(ST_SetSRID(ST_Point(wgs84_lon, wgs84_lat), 4326), 10)"
+
+
+class BatchEncoder:
+    """
+    Encodes batches of AddressBase Core rows (with lower case field names)
+    in PostgreSQL's binary COPY format for the staging table, so the server
+    doesn't have to parse them, with locations already as EWKB geometries.
+    The same buffer is reused for every batch, and a whole batch is written
+    in one go.
+    """
 
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.encode_json = json.JSONEncoder().encode
+
+    def encode_row(self, row):
+        columns, extra = split_record(row)
+        columns["addressbase_extra"] = self.encode_json(extra)
+        return b"".join(
+            [
+                ROW_START.pack(ROW_FIELDS, 8, columns["uprn"], EWKB_POINT.size),
+                EWKB_POINT.pack(
+                    1,
+                    EWKB_POINT_TYPE,
+                    SRID,
+                    float(row["easting"]),
+                    float(row["northing"]),
+                ),
+                *(encode(columns[c]) for c, encode in RECORD_COLUMNS.items()),
+            ]
+        )
 
-def process_row(row):
-    row = {k.lower(): v for k, v in row.items()}
-    row = (
-        row["uprn"],
-        row["postcode"].replace(" ", ""),
-        row["easting"],
-        row["northing"],
-        row["single_line_address"],
-        json.dumps(row),
-    )
-    f = io.StringIO()
-    writer(f).writerow(row)
-    row = f.getvalue()
-    row = row.encode()
-    return row
+    def encode(self, rows):
+        """
+        Return a file of the binary COPY data of rows, with the columns uprn,
+        location and RECORD_COLUMNS.
+        """
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(COPY_HEADER)
+        self.buffer.writelines(map(self.encode_row, rows))
+        self.buffer.write(COPY_TRAILER)
+        self.buffer.seek(0)
+        return self.buffer
 
 
 class Command(LabelCommand):
@@ -115,6 +200,9 @@ class Command(LabelCommand):
     purge = False
     dry_run = False
     incremental = False
+    skip_assignments = False
+    cluster = False
+    workers = 1
 
     def add_arguments(self, parser):
         super().add_arguments(parser)
@@ -150,19 +238,57 @@ class Command(LabelCommand):
             default=self.batch_size,
             help=f"Batch size for bulk INSERT/UPDATE operations. Default {self.batch_size}",
         )
+        parser.add_argument(
+            "--skip-assignments",
+            action="store_true",
+            dest="skip_assignments",
+            default=self.skip_assignments,
+            help="Don't update UPRN area assignments for changed rows (e.g. for a full load, "
+            "followed by mapit_labour_build_uprn_assignments)",
+        )
+        parser.add_argument(
+            "--cluster",
+            action="store_true",
+            dest="cluster",
+            default=self.cluster,
+            help="After importing, rewrite the UPRN table in spatial order, so queries for an "
+            "area read fewer pages. Each partition is locked while it's rewritten",
+        )
+        parser.add_argument(
+            "--workers",
+            dest="workers",
+            type=int,
+            default=self.workers,
+            help="Number of processes to import batches in parallel, each with its own "
+            f"database connection. Rows are split between them by UPRN. Default {self.workers}",
+        )
 
     def handle_label(self, label: str, **options):
         self.purge = options["purge"]
         self.incremental = options["incremental"]
         self.batch_size = options["batch_size"]
         self.dry_run = options["dry_run"]
+        self.skip_assignments = options["skip_assignments"]
+        self.cluster = options["cluster"]
+        self.workers = max(options["workers"], 1)
 
         with open_compressed_maybe(label, mode="rt", encoding="utf-8-sig") as f:
-            self.handle_start(DictReader(f))
+            csv = DictReader(f)
+            # Lower case the field names once, rather than every row's keys
+            csv.fieldnames = [name.lower() for name in csv.fieldnames or []]
+            self.handle_start(csv)
 
     def handle_start(self, csv: DictReader):
         if self.purge and not self.dry_run:
-            UPRN.objects.all().delete()
+            # Emptying every partition is far quicker than deleting each row,
+            # and leaves no dead tuples to be vacuumed
+            connection.cursor().execute(f"TRUNCATE {UPRN._meta.db_table}")
+            UPRNAssignment.objects.all().delete()
+            invalidate_all()
+
+        self.generation = None
+        if not self.skip_assignments:
+            self.generation = Generation.objects.current() or None
 
         if self.incremental:
             # query the DB to find when the most recent update was
@@ -171,9 +297,7 @@ class Command(LabelCommand):
                 ending="",
             )
             self.stdout.flush()
-            cutoff = UPRN.objects.values_list("addressbase", flat=True).order_by(
-                "-addressbase__last_update_date"
-            )[0]["last_update_date"]
+            cutoff = UPRN.objects.latest_update_date() or ""
             print(f"{cutoff}", file=self.stdout)
             csv = filter_old_rows(csv, cutoff)
 
@@ -183,52 +307,197 @@ class Command(LabelCommand):
             "updated": 0,
         }
 
+        self.encoder = BatchEncoder()
+        self.start = time.time()
+        if self.workers > 1:
+            self.import_parallel(csv)
+        else:
+            self.create_staging_table()
+            for i, rows in enumerate(batched(csv, self.batch_size), 1):
+                self.handle_rows(rows)
+                self.report_progress(i)
+            self.drop_staging_table()
+        print("", file=self.stdout)
+
         cursor = connection.cursor()
-        cursor.execute(
+        if self.purge and not self.dry_run:
+            # Refresh the planner statistics (and the admin's row count
+            # estimate) of the newly filled partitions
+            cursor.execute(f"ANALYZE {UPRN._meta.db_table}")
+            # Anything cached while the import was running is out of date
+            invalidate_all()
+        if self.cluster and not self.dry_run:
+            self.cluster_partitions()
+
+    def report_progress(self, batches):
+        dur = max(time.time() - self.start, 0.001)
+        self.stdout.write(
+            f"\rBatch {batches}, {dur:.0f}s, {batches/dur:.1f} batch/s, {self.count['total']/dur:.1f} row/s, {self.count['created']} created, {self.count['updated']} updated, {self.count['total']} total",
+            ending="",
+        )
+
+    def create_staging_table(self):
+        connection.cursor().execute(
             "CREATE TEMPORARY TABLE mapit_labour_uprn_new "
-            "(uprn bigint, postcode varchar(7), location geometry(Point, 27700), easting float, northing float, single_line_address text, addressbase jsonb) "
+            "(uprn bigint, location geometry(Point, 27700), postcode varchar(7), single_line_address text, usrn bigint, parent_uprn bigint, udprn bigint, toid text, classification_code text, last_update_date date, addressbase_extra jsonb) "
             "ON COMMIT DELETE ROWS"
         )
 
-        i = 0
+    def drop_staging_table(self):
+        connection.cursor().execute("DROP TABLE mapit_labour_uprn_new")
+
+    def import_parallel(self, csv):
+        """
+        Import batches in self.workers processes. Rows are split between the
+        workers by UPRN, so each UPRN is always handled by the same worker
+        and no two workers write the same row. The workers' counts and
+        progress are collected here as batches finish.
+        """
+        # Forked processes mustn't share the parent's database or cache
+        # connections, so close them and let each worker open its own
+        connections.close_all()
+        caches.close_all()
+        context = multiprocessing.get_context("fork")
+        # Bounded, so reading the CSV doesn't get too far ahead of the workers
+        tasks = [context.Queue(maxsize=2) for _ in range(self.workers)]
+        results = context.Queue()
+        self.processes = [
+            context.Process(target=import_worker, args=(self, q, results), daemon=True)
+            for q in tasks
+        ]
+        for process in self.processes:
+            process.start()
+
+        self.batches = 0
+        self.running = len(self.processes)
+        try:
+            buckets = [[] for _ in tasks]
+            for row in csv:
+                i = hash(row["uprn"]) % self.workers
+                buckets[i].append(row)
+                if len(buckets[i]) >= self.batch_size:
+                    self.put_task(tasks[i], buckets[i], results)
+                    buckets[i] = []
+            for q, rows in zip(tasks, buckets):
+                if rows:
+                    self.put_task(q, rows, results)
+                self.put_task(q, None, results)
+            while self.running:
+                self.collect_results(results, timeout=1)
+        finally:
+            for q, process in zip(tasks, self.processes):
+                if self.running:
+                    q.cancel_join_thread()
+                    process.terminate()
+                process.join()
+
+    def put_task(self, tasks, rows, results):
+        """Put rows on a worker's queue, collecting results while it's full."""
+        while True:
+            try:
+                tasks.put(rows, timeout=0.1)
+                return
+            except queue.Full:
+                self.collect_results(results)
+
+    def collect_results(self, results, timeout=0):
+        """
+        Handle the results the workers have put so far, waiting up to
+        timeout seconds for one.
+        """
+        try:
+            if timeout:
+                self.handle_result(results.get(timeout=timeout))
+            while True:
+                self.handle_result(results.get_nowait())
+        except queue.Empty:
+            if self.running and not any(p.is_alive() for p in self.processes):
+                raise CommandError("Import workers exited unexpectedly")
+
+    def handle_result(self, result):
+        if result is None:
+            self.running -= 1
+        elif isinstance(result, str):
+            raise CommandError(f"Import worker failed:\n{result}")
+        else:
+            self.batches += 1
+            for key, value in result.items():
+                self.count[key] += value
+            self.report_progress(self.batches)
+
+    def cluster_partitions(self):
+        """
+        CLUSTER each partition of the UPRN table on a temporary index of its
+        cluster key, one at a time so only one partition is locked at once.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT relid::regclass::text FROM pg_partition_tree(%s::regclass) "
+            "WHERE isleaf ORDER BY relid",
+            [UPRN._meta.db_table],
+        )
+        partitions = [row[0] for row in cursor.fetchall()]
         start = time.time()
-        for rows in batched(csv, self.batch_size):
-            i += 1
-            self.handle_rows(rows)
+        for i, partition in enumerate(partitions, 1):
+            with transaction.atomic():
+                index = f"{partition}_cluster_key"
+                cursor.execute(
+                    f"CREATE INDEX {index} ON {partition} ({CLUSTER_KEY_SQL})"
+                )
+                cursor.execute(f"CLUSTER {partition} USING {index}")
+                cursor.execute(f"DROP INDEX {index}")
+                cursor.execute(f"ANALYZE {partition}")
             dur = time.time() - start
             self.stdout.write(
-                f"\rBatch {i}, {dur:.0f}s, {i/dur:.1f} batch/s, {self.count['total']/dur:.1f} row/s, {self.count['created']} created, {self.count['updated']} updated, {self.count['total']} total",
+                f"\rClustered {i}/{len(partitions)} partitions, {dur:.0f}s",
                 ending="",
             )
         print("", file=self.stdout)
 
-        cursor.execute("DROP TABLE mapit_labour_uprn_new")
-
-    def handle_rows(self, csv):
-        csv = map(process_row, csv)
-        csv = iterable_to_stream(csv)
+    def handle_rows(self, rows):
+        data = self.encoder.encode(rows)
 
         with transaction.atomic():
             cursor = connection.cursor()
             cursor.copy_expert(
-                "COPY mapit_labour_uprn_new(uprn, postcode, easting, northing, single_line_address, addressbase) "
-                "FROM STDIN WITH (FORMAT csv)",
-                csv,
+                f"COPY mapit_labour_uprn_new(uprn, location, {', '.join(RECORD_COLUMNS)}) "
+                "FROM STDIN WITH (FORMAT binary)",
+                data,
             )
             self.count["total"] += cursor.rowcount
-            cursor.execute(
-                "UPDATE mapit_labour_uprn_new SET location = ST_SetSRID(ST_Point(easting, northing), 27700)"
+            # Transform the rows being written to WGS84 here rather than every
+            # time a UPRN is output.
+            new_rows = (
+                "(SELECT *, ST_Transform(location, 4326) AS wgs84 "
+                "FROM mapit_labour_uprn_new) n "
             )
             cursor.execute(
-                "UPDATE mapit_labour_uprn SET postcode = n.postcode, location = n.location, single_line_address = n.single_line_address, addressbase = n.addressbase "
-                "FROM mapit_labour_uprn_new n "
-                "WHERE n.addressbase IS DISTINCT FROM mapit_labour_uprn.addressbase AND n.uprn = mapit_labour_uprn.uprn"
+                "UPDATE mapit_labour_uprn SET location = n.location, wgs84_lon = ST_X(n.wgs84), wgs84_lat = ST_Y(n.wgs84), "
+                f"{', '.join(f'{c} = n.{c}' for c in RECORD_COLUMNS)} "
+                f"FROM {new_rows}"
+                f"WHERE ({', '.join(f'n.{c}' for c in RECORD_COLUMNS)}) "
+                f"IS DISTINCT FROM ({', '.join(f'mapit_labour_uprn.{c}' for c in RECORD_COLUMNS)}) "
+                "AND n.uprn = mapit_labour_uprn.uprn "
+                "RETURNING mapit_labour_uprn.uprn"
             )
-            self.count["updated"] += cursor.rowcount
+            updated = [row[0] for row in cursor.fetchall()]
+            self.count["updated"] += len(updated)
             cursor.execute(
-                "INSERT INTO mapit_labour_uprn (uprn, postcode, location, single_line_address, addressbase) "
-                "SELECT n.uprn, n.postcode, n.location, n.single_line_address, n.addressbase FROM mapit_labour_uprn_new n "
-                "LEFT JOIN mapit_labour_uprn p ON n.uprn = p.uprn WHERE p.uprn IS NULL"
+                f"INSERT INTO mapit_labour_uprn (uprn, location, wgs84_lon, wgs84_lat, {', '.join(RECORD_COLUMNS)}) "
+                f"SELECT n.uprn, n.location, ST_X(n.wgs84), ST_Y(n.wgs84), {', '.join(f'n.{c}' for c in RECORD_COLUMNS)} "
+                f"FROM {new_rows}"
+                "LEFT JOIN mapit_labour_uprn p ON n.uprn = p.uprn WHERE p.uprn IS NULL "
+                # Keep each batch of new UPRNs in spatial order, by the same
+                # key as CLUSTER_KEY_SQL
+                "ORDER BY ST_GeoHash(n.wgs84, 10) "
+                "RETURNING uprn"
             )
-            self.count["created"] += cursor.rowcount
+            created = [row[0] for row in cursor.fetchall()]
+            self.count["created"] += len(created)
+            if self.generation and (updated or created):
+                UPRNAssignment.objects.refresh(self.generation, uprns=updated + created)
+            # A purge invalidates everything once the import's finished
+            # instead, rather than a version token for every UPRN
+            if not self.purge and (updated or created):
+                transaction.on_commit(partial(invalidate_uprns, updated))
             transaction.set_rollback(self.dry_run)
@@ -0,0 +1,167 @@
+import csv
+import io
+import re
+import sys
+import time
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from mapit_labour.utils import batched
+
+POSTCODE = re.compile(r"\b([A-Z]{1,2}[0-9][A-Z0-9]?) ?([0-9][A-Z]{2})\b")
+
+# Candidates are every UPRN in the input address's postcode, scored on the
+# trigram similarity of the whole address and how well the building part of
+# the AddressBase record (its number/name, or the organisation) matches a
+# part of the input address, and the best for each input row is returned.
+# Records with no building part at all (e.g. PO boxes) score 0 for it.
+MATCH_SQL = """
+    SELECT DISTINCT ON (i.row_id) i.row_id, u.uprn, u.single_line_address, (
+        2 * similarity(u.single_line_address, i.address) + COALESCE(word_similarity(
+            COALESCE(
+                NULLIF(concat_ws(' ',
+                    u.addressbase_extra->>'sub_building',
+                    u.addressbase_extra->>'building_name',
+                    u.addressbase_extra->>'building_number'
+                ), ''),
+                u.addressbase_extra->>'organisation'
+            ),
+            i.address
+        ), 0)
+    ) / 3 AS score
+    FROM mapit_labour_match_input i
+    JOIN mapit_labour_uprn u ON u.postcode = i.postcode
+    ORDER BY i.row_id, score DESC NULLS LAST, u.uprn
+"""
+
+
+def normalise_address(address):
+    address = re.sub(r"[^A-Z0-9,]+", " ", address.upper())
+    return re.sub(r" *, *", ", ", address).strip(" ,")
+
+
+def normalise_postcode(postcode):
+    return re.sub(r"\s+", "", postcode.upper())
+
+
+class Command(BaseCommand):
+    help = (
+        "Matches a CSV of free-text addresses to UPRNs, writing out the CSV with "
+        "the best matching UPRN, its address and a score from 0 to 1 added to each row"
+    )
+
+    batch_size = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="CSV file of addresses, or - for STDIN")
+        parser.add_argument(
+            "--output",
+            help="File to write the matched CSV to. Default is STDOUT",
+        )
+        parser.add_argument(
+            "--address-column",
+            default="address",
+            help="Column containing the address. Default 'address'",
+        )
+        parser.add_argument(
+            "--postcode-column",
+            help="Column containing the postcode. Default is to find it in the address",
+        )
+        parser.add_argument(
+            "--min-score",
+            type=float,
+            default=0,
+            help="Don't output matches scoring less than this",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=self.batch_size,
+            help=f"Number of rows to match at once. Default {self.batch_size}",
+        )
+
+    def handle(self, **options):
+        with ExitStack() as stack:
+            if options["input"] == "-":
+                infile = io.TextIOWrapper(
+                    sys.stdin.buffer, encoding="utf-8-sig", newline=""
+                )
+            else:
+                infile = stack.enter_context(
+                    open(options["input"], encoding="utf-8-sig", newline="")
+                )
+            outfile = self.stdout
+            if options["output"]:
+                outfile = stack.enter_context(open(options["output"], "w", newline=""))
+            self.match_csv(csv.DictReader(infile), outfile, options)
+
+    def match_csv(self, reader, outfile, options):
+        if options["address_column"] not in (reader.fieldnames or []):
+            raise CommandError(
+                f"No '{options['address_column']}' column in the input CSV"
+            )
+        writer = csv.writer(outfile, lineterminator="\n")
+        writer.writerow(reader.fieldnames + ["uprn", "matched_address", "match_score"])
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS mapit_labour_match_input "
+            "(row_id integer, postcode varchar(7), address text)"
+        )
+        try:
+            count = matched = 0
+            start = time.time()
+            for rows in batched(reader, options["batch_size"]):
+                matches = self.match(rows, options)
+                for row_id, row in enumerate(rows):
+                    uprn, address, score = matches.get(row_id, ("", "", None))
+                    if score is None or score < options["min_score"]:
+                        uprn, address, score = "", "", ""
+                    else:
+                        matched += 1
+                        score = round(score, 3)
+                    writer.writerow(list(row.values()) + [uprn, address, score])
+                count += len(rows)
+                dur = time.time() - start
+                self.stderr.write(
+                    f"\r{count} rows, {matched} matched, {count/max(dur, 0.001):.1f} row/s",
+                    ending="",
+                )
+            self.stderr.write("")
+        finally:
+            cursor.execute("DROP TABLE mapit_labour_match_input")
+
+    def match(self, rows, options):
+        """
+        Return a dict of the index of each row in rows to the (UPRN, address,
+        score) of its best match, using a single query for the whole batch.
+        """
+        f = io.StringIO()
+        out = csv.writer(f)
+        for row_id, row in enumerate(rows):
+            address = row[options["address_column"]] or ""
+            if options["postcode_column"]:
+                postcode = normalise_postcode(row[options["postcode_column"]] or "")
+            elif m := POSTCODE.search(address.upper()):
+                postcode = m.group(1) + m.group(2)
+            else:
+                postcode = ""
+            if postcode:
+                out.writerow((row_id, postcode[:7], normalise_address(address)))
+        f.seek(0)
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("TRUNCATE mapit_labour_match_input")
+            cursor.copy_expert(
+                "COPY mapit_labour_match_input(row_id, postcode, address) "
+                "FROM STDIN WITH (FORMAT csv)",
+                f,
+            )
+            cursor.execute(MATCH_SQL)
+            return {
+                row_id: (uprn, address, score)
+                for row_id, uprn, address, score in cursor.fetchall()
+            }
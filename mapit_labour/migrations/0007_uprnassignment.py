@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-16 09:12
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0001_initial'),
+        ('mapit_labour', '0006_alter_csvimporttaskprogress_task_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UPRNAssignment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uprn', models.PositiveBigIntegerField()),
+                ('areas', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                ('generation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mapit.generation')),
+            ],
+            options={
+                'verbose_name': 'UPRN assignment',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='uprnassignment',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['areas'], name='mapit_labour_assignment_areas'),
+        ),
+        migrations.AddConstraint(
+            model_name='uprnassignment',
+            constraint=models.UniqueConstraint(fields=('uprn', 'generation'), name='mapit_labour_uprnassignment_unique'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-16 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0007_uprnassignment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uprn',
+            name='wgs84_lat',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='wgs84_lon',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE mapit_labour_uprn SET "
+            "wgs84_lon = ST_X(ST_Transform(location, 4326)), "
+            "wgs84_lat = ST_Y(ST_Transform(location, 4326))",
+            migrations.RunSQL.noop,
+        ),
+    ]
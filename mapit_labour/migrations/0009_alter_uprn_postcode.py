@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0008_uprn_wgs84'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uprn',
+            name='postcode',
+            field=models.CharField(db_index=True, max_length=7),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 12:41
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0009_alter_uprn_postcode'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.fields.json.KeyTransform('last_update_date', 'addressbase'), name='mapit_labour_uprn_lud_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-16 13:20
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0010_uprn_lud_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.fields.json.KeyTransform('usrn', 'addressbase'), name='mapit_labour_ab_usrn_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.fields.json.KeyTransform('parent_uprn', 'addressbase'), name='mapit_labour_ab_parent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.fields.json.KeyTransform('toid', 'addressbase'), name='mapit_labour_ab_toid_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 13:52
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0011_addressbase_key_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uprn',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['single_line_address'], name='mapit_labour_sl_address_gist', opclasses=['gist_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,191 @@
+# Generated by Django 4.2.30 on 2026-10-16 15:05
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+def integer_sql(field):
+    return (
+        f"{field} = CASE WHEN addressbase->>'{field}' ~ '^(0|[1-9][0-9]{{0,17}})$' "
+        f"THEN (addressbase->>'{field}')::bigint END"
+    )
+
+
+# Move the fields stored in columns out of the AddressBase records, keeping
+# any value that the column can't reproduce exactly in addressbase_extra
+# (see mapit_labour.addressbase.split_record)
+SPLIT_SQL = f"""
+CREATE FUNCTION pg_temp.mapit_labour_to_date(value text) RETURNS date AS $$
+BEGIN
+    IF value::date::text = value THEN
+        RETURN value::date;
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+UPDATE mapit_labour_uprn SET
+    {integer_sql("usrn")},
+    {integer_sql("parent_uprn")},
+    {integer_sql("udprn")},
+    toid = COALESCE(addressbase->>'toid', ''),
+    classification_code = COALESCE(addressbase->>'classification_code', ''),
+    last_update_date = pg_temp.mapit_labour_to_date(addressbase->>'last_update_date');
+
+UPDATE mapit_labour_uprn SET addressbase_extra = (
+    SELECT COALESCE(jsonb_object_agg(key, value), '{{}}'::jsonb)
+    FROM jsonb_each(addressbase)
+    WHERE NOT (
+        (value = '""'::jsonb AND key = ANY(ARRAY[
+            'parent_uprn', 'udprn', 'usrn', 'toid', 'classification_code', 'easting',
+            'northing', 'latitude', 'longitude', 'rpc', 'last_update_date', 'po_box',
+            'organisation', 'sub_building', 'building_name', 'building_number',
+            'street_name', 'locality', 'town_name', 'post_town', 'island',
+            'delivery_point_suffix', 'gss_code', 'change_code'
+        ]))
+        OR (key = 'uprn' AND value = to_jsonb(uprn::text))
+        OR (key = 'parent_uprn' AND value = to_jsonb(COALESCE(parent_uprn::text, '')))
+        OR (key = 'udprn' AND value = to_jsonb(COALESCE(udprn::text, '')))
+        OR (key = 'usrn' AND value = to_jsonb(COALESCE(usrn::text, '')))
+        OR (key = 'toid' AND value = to_jsonb(toid))
+        OR (key = 'classification_code' AND value = to_jsonb(classification_code))
+        OR (key = 'last_update_date' AND value = to_jsonb(
+            COALESCE(to_char(last_update_date, 'YYYY-MM-DD'), '')
+        ))
+        OR (key = 'single_line_address' AND value = to_jsonb(single_line_address))
+        OR (key = 'postcode' AND value = to_jsonb(
+            CASE WHEN length(postcode) > 3
+            THEN left(postcode, -3) || ' ' || right(postcode, 3)
+            ELSE postcode END
+        ))
+    )
+);
+"""
+
+# The reverse of SPLIT_SQL: rebuild the whole records from the columns and
+# addressbase_extra, as mapit_labour.addressbase.RECORD_SQL does
+JOIN_SQL = """
+UPDATE mapit_labour_uprn SET addressbase = jsonb_build_object(
+    'uprn', uprn::text,
+    'parent_uprn', COALESCE(parent_uprn::text, ''),
+    'udprn', COALESCE(udprn::text, ''),
+    'usrn', COALESCE(usrn::text, ''),
+    'toid', toid,
+    'classification_code', classification_code,
+    'easting', '', 'northing', '', 'latitude', '', 'longitude', '', 'rpc', '',
+    'last_update_date', COALESCE(to_char(last_update_date, 'YYYY-MM-DD'), ''),
+    'single_line_address', single_line_address,
+    'po_box', '', 'organisation', '', 'sub_building', '', 'building_name', '',
+    'building_number', '', 'street_name', '', 'locality', '', 'town_name', '',
+    'post_town', '', 'island', '',
+    'postcode', CASE WHEN length(postcode) > 3
+        THEN left(postcode, -3) || ' ' || right(postcode, 3)
+        ELSE postcode END,
+    'delivery_point_suffix', '', 'gss_code', '', 'change_code', ''
+) || addressbase_extra;
+"""
+
+# What's left of each record is small enough to be stored inline, so have
+# PostgreSQL compress it there (with lz4 where the server supports it)
+COMPRESSION_SQL = """
+DO $$
+BEGIN
+    IF current_setting('server_version_num')::int >= 140000 THEN
+        EXECUTE 'ALTER TABLE mapit_labour_uprn ALTER COLUMN addressbase_extra SET COMPRESSION lz4';
+    END IF;
+EXCEPTION WHEN feature_not_supported THEN
+    NULL;
+END
+$$;
+ALTER TABLE mapit_labour_uprn SET (toast_tuple_target = 256);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0012_uprn_sl_address_gist'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uprn',
+            name='usrn',
+            field=models.PositiveBigIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='parent_uprn',
+            field=models.PositiveBigIntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='udprn',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='toid',
+            field=models.TextField(default='', editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='classification_code',
+            field=models.TextField(default='', editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='last_update_date',
+            field=models.DateField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='uprn',
+            name='addressbase_extra',
+            field=models.JSONField(default=dict),
+        ),
+        # Nullable so that when migrating backwards it can be added back
+        # before JOIN_SQL fills it in
+        migrations.AlterField(
+            model_name='uprn',
+            name='addressbase',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunSQL(SPLIT_SQL, JOIN_SQL),
+        migrations.RemoveIndex(
+            model_name='uprn',
+            name='mapit_labou_address_655eac_gin',
+        ),
+        migrations.RemoveIndex(
+            model_name='uprn',
+            name='mapit_labour_uprn_lud_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='uprn',
+            name='mapit_labour_ab_usrn_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='uprn',
+            name='mapit_labour_ab_parent_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='uprn',
+            name='mapit_labour_ab_toid_idx',
+        ),
+        migrations.RemoveField(
+            model_name='uprn',
+            name='addressbase',
+        ),
+        migrations.AddIndex(
+            model_name='uprn',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['addressbase_extra'], name='mapit_labour_ab_extra_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(fields=['toid'], name='mapit_labour_uprn_toid_idx'),
+        ),
+        migrations.RunSQL(COMPRESSION_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,86 @@
+from django.db import migrations
+
+# Number of hash partitions of mapit_labour_uprn, each of which holds about
+# 2.5 million UPRNs of a full AddressBase Core import
+PARTITIONS = 16
+
+
+def rebuild_uprns(schema_editor, partitioned):
+    """
+    Replace mapit_labour_uprn with a table that's either partitioned by hash
+    of UPRN or not, with the same columns, constraints and (identically
+    named) indexes.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT i.indexname, i.indexdef, c.conname FROM pg_indexes i "
+            "LEFT JOIN pg_constraint c ON c.conindid = (i.schemaname || '.' || i.indexname)::regclass "
+            "AND c.contype = 'p' "
+            "WHERE i.schemaname = current_schema() AND i.tablename = 'mapit_labour_uprn'"
+        )
+        indexes = cursor.fetchall()
+
+    schema_editor.execute("ALTER TABLE mapit_labour_uprn RENAME TO mapit_labour_uprn_old")
+    schema_editor.execute(
+        "CREATE TABLE mapit_labour_uprn (LIKE mapit_labour_uprn_old "
+        "INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)"
+        + (" PARTITION BY HASH (uprn)" if partitioned else "")
+    )
+    if partitioned:
+        for i in range(PARTITIONS):
+            schema_editor.execute(
+                f"CREATE TABLE mapit_labour_uprn_p{i} PARTITION OF mapit_labour_uprn "
+                f"FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {i}) "
+                # See 0013_uprn_addressbase_columns
+                "WITH (toast_tuple_target = 256)"
+            )
+    else:
+        schema_editor.execute(
+            "ALTER TABLE mapit_labour_uprn SET (toast_tuple_target = 256)"
+        )
+    schema_editor.execute("INSERT INTO mapit_labour_uprn SELECT * FROM mapit_labour_uprn_old")
+    # This drops the partitions of a partitioned table too
+    schema_editor.execute("DROP TABLE mapit_labour_uprn_old")
+
+    # Indexes created on the partitioned table are created on every partition
+    for name, definition, constraint in indexes:
+        if constraint:
+            schema_editor.execute(
+                f'ALTER TABLE mapit_labour_uprn ADD CONSTRAINT "{constraint}" PRIMARY KEY (uprn)'
+            )
+        else:
+            # A partitioned table's indexes are defined ON ONLY it
+            schema_editor.execute(definition.replace(" ON ONLY ", " ON ", 1))
+
+    schema_editor.execute(
+        """
+        DO $$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 140000 THEN
+                EXECUTE 'ALTER TABLE mapit_labour_uprn ALTER COLUMN addressbase_extra SET COMPRESSION lz4';
+            END IF;
+        EXCEPTION WHEN feature_not_supported THEN
+            NULL;
+        END
+        $$
+        """
+    )
+
+
+def partition_uprns(apps, schema_editor):
+    rebuild_uprns(schema_editor, partitioned=True)
+
+
+def unpartition_uprns(apps, schema_editor):
+    rebuild_uprns(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0013_uprn_addressbase_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_uprns, unpartition_uprns),
+    ]
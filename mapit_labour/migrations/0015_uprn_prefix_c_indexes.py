@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:55
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit_labour', '0014_partition_uprn'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.functions.comparison.Collate('single_line_address', 'C'), models.F('uprn'), name='mapit_labour_sl_address_c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uprn',
+            index=models.Index(django.db.models.functions.comparison.Collate(django.db.models.functions.comparison.Cast('postcode', models.TextField()), 'C'), models.F('uprn'), name='mapit_labour_postcode_c_idx'),
+        ),
+    ]
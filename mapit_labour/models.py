@@ -3,21 +3,277 @@ from __future__ import unicode_literals
 import re
 import string
 import random
+from operator import itemgetter
+from typing import NamedTuple
+
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.contrib.gis.db import models
-from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.gis.db.models.functions import Transform
+from django.db.models import F, Func
+from django.db.models.functions import Cast, Coalesce, Collate, JSONObject
+from django.db.models.expressions import RawSQL
 from django.dispatch import receiver
 from django.apps import apps
 
-from mapit.models import str2int
+from mapit.models import Area, Generation, Geometry, str2int
+
+from .addressbase import (
+    COLUMNS as ADDRESSBASE_COLUMNS,
+    FIELDS as ADDRESSBASE_FIELDS,
+    RECORD_SQL as ADDRESSBASE_RECORD_SQL,
+    STORED_COLUMNS as ADDRESSBASE_STORED_COLUMNS,
+    build_record,
+    field_sql,
+    record_from_values,
+)
+from .cache import invalidate_all
+from .shortcuts import RawJSON
+
+
+# Whether a UPRN lies within an area. The bounding box test lets PostgreSQL
+# use the spatial index on UPRN locations, before the exact test against the
+# area's subdivided geometries.
+WITHIN_AREA_SQL = (
+    "mapit_labour_uprn.location && ("
+    f"  SELECT ST_SetSRID(ST_Extent(polygon)::geometry, {settings.MAPIT_AREA_SRID})"
+    "  FROM mapit_geometry WHERE area_id = %s"
+    ") AND EXISTS ("
+    "  SELECT 1 FROM mapit_geometrysubdivided s"
+    "  JOIN mapit_geometry g ON g.id = s.geometry_id"
+    "  WHERE g.area_id = %s AND ST_Covers(s.division, mapit_labour_uprn.location)"
+    ")"
+)
+
+
+class X(Func):
+    function = "ST_X"
+    output_field = models.FloatField()
+
+
+class Y(Func):
+    function = "ST_Y"
+    output_field = models.FloatField()
+
+
+def addressbase_columns(fields, raw=False):
+    """
+    Return the columns to fetch for AddressBase records (or just the given
+    fields of them, if any, from UPRN.objects.with_addressbase_fields) and
+    a function building a record from their values. With raw, the record
+    is the RawJSON from UPRN.objects.with_addressbase_json instead.
+    """
+    if raw:
+        return ["addressbase_json"], lambda values: RawJSON(values[0])
+    if fields:
+        return ["addressbase_fields"], itemgetter(0)
+    return ADDRESSBASE_STORED_COLUMNS, record_from_values
+
+
+class UPRNRow(NamedTuple):
+    """
+    A UPRN as returned by UPRNQuerySet.rows(): just what as_dict() needs,
+    built straight from the database values rather than a model instance
+    with a GEOS point.
+    """
+
+    uprn: int
+    postcode: str
+    addressbase: dict  # or RawJSON, see UPRNQuerySet.rows
+    wgs84_lon: float
+    wgs84_lat: float
+    easting: float
+    northing: float
+
+    def as_dict(self, skip_location=False):
+        """The same as UPRN.as_dict()."""
+        d = {
+            "uprn": self.uprn,
+            "postcode": self.postcode,
+            "addressbase_core": self.addressbase,
+        }
+        if not skip_location:
+            d["wgs84_lon"] = self.wgs84_lon
+            d["wgs84_lat"] = self.wgs84_lat
+            d["easting"] = self.easting
+            d["northing"] = self.northing
+        return d
+
+
+class UPRNQuerySet(models.QuerySet):
+    def latest_update_date(self):
+        """
+        The most recent AddressBase LAST_UPDATE_DATE, as a string, found
+        with the index on that column.
+        """
+        latest = (
+            self.order_by(F("last_update_date").desc(nulls_last=True))
+            .values_list("last_update_date", flat=True)
+            .first()
+        )
+        return latest.isoformat() if latest else None
+
+    def addressbase_lookup(self, lookup):
+        """
+        Filter on a dict of AddressBase field names and values. Fields stored
+        in columns are looked up with those columns' indexes, and the rest
+        with a single containment query against the GIN index.
+        """
+        qs = self
+        contains = {}
+        for field, value in lookup.items():
+            if field in ADDRESSBASE_COLUMNS:
+                to_column, from_column = ADDRESSBASE_COLUMNS[field]
+                column = to_column(value)
+                if from_column(column) != value:
+                    # The value can only be stored in addressbase_extra
+                    contains[field] = value
+                    continue
+                qs = qs.filter(**{field: column})
+            elif value or field not in ADDRESSBASE_FIELDS:
+                contains[field] = value
+                continue
+            # Exclude records whose original value was kept in
+            # addressbase_extra, e.g. a postcode without its space
+            qs = qs.exclude(addressbase_extra__has_key=field)
+        if contains:
+            qs = qs.filter(addressbase_extra__contains=contains)
+        return qs
+
+    def with_addressbase_fields(self, fields):
+        """
+        Fetch only the given AddressBase fields, extracted by PostgreSQL,
+        instead of the whole AddressBase record. as_dict() returns just
+        these fields when they've been fetched.
+        """
+        if not fields:
+            return self
+        return self.defer("addressbase_extra").annotate(
+            addressbase_fields=JSONObject(
+                **{
+                    field: RawSQL(
+                        field_sql(field),
+                        (field,),
+                        output_field=models.TextField(),
+                    )
+                    for field in fields
+                }
+            )
+        )
+
+    def with_addressbase_json(self, fields=None):
+        """
+        Like with_addressbase_fields, but annotate the whole AddressBase
+        record (or just the given fields of it) as addressbase_json, the
+        JSON text of the record as encode_json would output it, so it can
+        be output without decoding and encoding it again.
+        """
+        if fields:
+            sql = "jsonb_build_object(%s)::text" % ", ".join(
+                f"%s, {field_sql(field)}" for field in fields
+            )
+            params = [param for field in fields for param in (field, field)]
+        else:
+            sql, params = ADDRESSBASE_RECORD_SQL, []
+        return self.defer("addressbase_extra").annotate(
+            addressbase_json=RawSQL(sql, params, output_field=models.TextField())
+        )
+
+    def rows(self, fields=None, chunk_size=None, raw=False):
+        """
+        Iterate over the UPRNs as UPRNRows, with their whole AddressBase
+        records or just the given fields of them. This skips creating model
+        instances and geometries, which is most of the cost of outputting
+        a UPRN. With chunk_size, rows are read from a server-side cursor.
+        With raw, the records are RawJSON, for encode_json.
+        """
+        columns, build = addressbase_columns(fields, raw)
+        if raw:
+            qs = self.with_addressbase_json(fields)
+        else:
+            qs = self.with_addressbase_fields(fields)
+        qs = qs.annotate(
+            row_lon=Coalesce("wgs84_lon", X(Transform("location", 4326))),
+            row_lat=Coalesce("wgs84_lat", Y(Transform("location", 4326))),
+            row_easting=X("location"),
+            row_northing=Y("location"),
+        ).values_list(
+            "uprn",
+            "postcode",
+            "row_lon",
+            "row_lat",
+            "row_easting",
+            "row_northing",
+            *columns,
+        )
+        values = qs.iterator(chunk_size=chunk_size) if chunk_size else qs
+        for uprn, postcode, lon, lat, easting, northing, *addressbase in values:
+            yield UPRNRow(
+                uprn, postcode, build(addressbase), lon, lat, easting, northing
+            )
+
+    def within_area(self, area_id):
+        return self.filter(
+            RawSQL(
+                WITHIN_AREA_SQL, (area_id, area_id), output_field=models.BooleanField()
+            )
+        )
+
+
+# Single line addresses and postcodes in the "C" collation, so that an index
+# on them can answer LIKE 'prefix%' queries in order, whatever the database's
+# collation is. Lookups on them (as text) need to match the indexes exactly.
+ADDRESS_C = Collate("single_line_address", "C")
+POSTCODE_C = Collate(Cast("postcode", models.TextField()), "C")
+
+
+class UPRNManager(models.Manager.from_queryset(UPRNQuerySet)):
+    def area_ids(self, uprns, query):
+        """
+        Return a dict mapping each of the given UPRNs to a list of the IDs of
+        the areas (matching query, as returned by Generation.objects.query_args)
+        that contain it. This is a single spatial join of the UPRN table against
+        the subdivided area geometries, rather than one by_location query per UPRN.
+        """
+        areas_sql, areas_params = (
+            Area.objects.filter(query).values("id").query.sql_with_params()
+        )
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT u.uprn, a.id FROM mapit_labour_uprn u "
+            "JOIN mapit_geometrysubdivided s ON ST_Covers(s.division, u.location) "
+            "JOIN mapit_geometry g ON g.id = s.geometry_id "
+            "JOIN mapit_area a ON a.id = g.area_id "
+            f"WHERE u.uprn = ANY(%s) AND a.id IN ({areas_sql}) "
+            # Area's default ordering
+            "GROUP BY u.uprn, a.id ORDER BY u.uprn, a.name, a.type_id",
+            [list(uprns), *areas_params],
+        )
+        result = {}
+        for uprn, area_id in cursor.fetchall():
+            result.setdefault(uprn, []).append(area_id)
+        return result
 
 
 class UPRN(models.Model):
     uprn = models.PositiveBigIntegerField(primary_key=True)
-    postcode = models.CharField(max_length=7)
+    postcode = models.CharField(max_length=7, db_index=True)
     location = models.PointField(srid=27700)
-    addressbase = models.JSONField()
+
+    # The most used fields of the AddressBase Core record, in typed columns,
+    # and the rest of the record (see mapit_labour.addressbase). Use the
+    # addressbase property for the whole record.
+    usrn = models.PositiveBigIntegerField(null=True, db_index=True, editable=False)
+    parent_uprn = models.PositiveBigIntegerField(
+        null=True, db_index=True, editable=False
+    )
+    udprn = models.PositiveBigIntegerField(null=True, editable=False)
+    toid = models.TextField(editable=False)
+    classification_code = models.TextField(editable=False)
+    last_update_date = models.DateField(null=True, db_index=True, editable=False)
+    addressbase_extra = models.JSONField(default=dict)
 
     # It's unnecessarily complex to index the value of a key in a JSONB
     # field and perform `LIKE %`-style matching, so this field has been
@@ -25,26 +281,57 @@ class UPRN(models.Model):
     # the model.
     single_line_address = models.TextField(db_index=True, editable=False)
 
+    # WGS84 coordinates of location, transformed in bulk at import time
+    # so that outputting a UPRN doesn't need a trip to the database.
+    wgs84_lon = models.FloatField(null=True, editable=False)
+    wgs84_lat = models.FloatField(null=True, editable=False)
+
+    objects = UPRNManager()
+
     class Meta:
         ordering = ("uprn",)
         indexes = [
-            GinIndex(fields=["addressbase"]),
+            GinIndex(name="mapit_labour_ab_extra_gin", fields=["addressbase_extra"]),
+            models.Index(name="mapit_labour_uprn_toid_idx", fields=["toid"]),
+            # Prefix lookups for address suggestions, in the order they're
+            # returned (see ADDRESS_C)
+            models.Index(ADDRESS_C, F("uprn"), name="mapit_labour_sl_address_c_idx"),
+            models.Index(POSTCODE_C, F("uprn"), name="mapit_labour_postcode_c_idx"),
             GinIndex(
                 name="mapit_labour_sl_address_gin",
                 fields=["single_line_address"],
                 opclasses=["gin_trgm_ops"],
             ),
+            # Used for nearest-neighbour ordering by trigram distance, which
+            # the GIN index can't do
+            GistIndex(
+                name="mapit_labour_sl_address_gist",
+                fields=["single_line_address"],
+                opclasses=["gist_trgm_ops"],
+            ),
         ]
         verbose_name = "UPRN"
 
+    @property
+    def addressbase(self):
+        """The whole AddressBase Core record, as it was imported."""
+        return build_record(
+            {field: getattr(self, field) for field in ADDRESSBASE_COLUMNS},
+            self.addressbase_extra,
+        )
+
     def __str__(self):
         return str(self.uprn)
 
     def as_dict(self, skip_location=False):
+        if "addressbase_fields" in self.__dict__:
+            addressbase = self.addressbase_fields
+        else:
+            addressbase = self.addressbase
         d = {
             "uprn": self.uprn,
             "postcode": self.postcode,
-            "addressbase_core": self.addressbase,
+            "addressbase_core": addressbase,
         }
         if not skip_location:
             (lon, lat) = self.as_wgs84()
@@ -59,6 +346,8 @@ class UPRN(models.Model):
         return d
 
     def as_wgs84(self):
+        if self.wgs84_lon is not None and self.wgs84_lat is not None:
+            return [self.wgs84_lon, self.wgs84_lat]
         cursor = connection.cursor()
         srid = 4326
         cursor.execute(
@@ -70,6 +359,102 @@ class UPRN(models.Model):
         return list(map(float, m.groups()))
 
 
+class UPRNAssignmentManager(models.Manager):
+    def area_ids(self, uprns, generation):
+        """
+        Return a dict mapping each of the given UPRNs that has an assignment
+        in generation to the list of IDs of the areas containing it.
+        """
+        return dict(
+            self.filter(uprn__in=uprns, generation=generation).values_list(
+                "uprn", "areas"
+            )
+        )
+
+    def refresh(self, generation, uprns=None, areas=None):
+        """
+        Rebuild the assignments for generation, set-based. If uprns is given
+        only those UPRNs are rebuilt; if areas is given, only the UPRNs that
+        were previously assigned to or now fall within any of those areas.
+        With neither, every UPRN is rebuilt.
+        """
+        if (pending := AreaChanges.pending(generation)) is not None:
+            if areas is None and uprns is None:
+                pending.clear()
+            elif areas is not None:
+                pending.difference_update(areas)
+
+        cursor = connection.cursor()
+        if areas is not None:
+            cursor.execute(
+                "SELECT uprn FROM mapit_labour_uprnassignment "
+                "WHERE generation_id = %s AND areas && %s::integer[] "
+                "UNION SELECT u.uprn FROM mapit_labour_uprn u "
+                "JOIN mapit_geometrysubdivided s ON ST_Covers(s.division, u.location) "
+                "JOIN mapit_geometry g ON g.id = s.geometry_id "
+                "WHERE g.area_id = ANY(%s)",
+                [generation.id, list(areas), list(areas)],
+            )
+            uprns = [row[0] for row in cursor.fetchall()]
+
+        if uprns is None:
+            where, params = "TRUE", []
+        else:
+            where, params = "u.uprn = ANY(%s)", [list(uprns)]
+
+        cursor.execute(
+            "DELETE FROM mapit_labour_uprnassignment u "
+            f"WHERE u.generation_id = %s AND {where}",
+            [generation.id, *params],
+        )
+        # UPRNs that aren't in any area still get an (empty) assignment so
+        # lookups for them don't fall back to a spatial query.
+        cursor.execute(
+            "INSERT INTO mapit_labour_uprnassignment (uprn, generation_id, areas) "
+            "SELECT u.uprn, %s, COALESCE(array_agg(DISTINCT g.area_id) FILTER (WHERE g.area_id IS NOT NULL), '{}') "
+            "FROM mapit_labour_uprn u "
+            "LEFT JOIN (mapit_geometrysubdivided s "
+            "  JOIN mapit_geometry g ON g.id = s.geometry_id "
+            "  JOIN mapit_area a ON a.id = g.area_id "
+            "    AND a.generation_low_id <= %s AND a.generation_high_id >= %s"
+            ") ON ST_Covers(s.division, u.location) "
+            f"WHERE {where} GROUP BY u.uprn",
+            [generation.id, generation.id, generation.id, *params],
+        )
+        return cursor.rowcount
+
+
+class UPRNAssignment(models.Model):
+    """
+    The areas containing each UPRN in a particular generation, precomputed
+    so UPRN lookups don't need to do any geometry work at request time.
+    It's rebuilt for the affected UPRNs after AddressBase and branch imports,
+    and for the current generation whenever one of its areas or their
+    geometries changes. A generation's assignments are deleted when it's
+    activated, until mapit_labour_build_uprn_assignments rebuilds them;
+    lookups fall back to a spatial query for any UPRN that isn't present.
+    """
+
+    uprn = models.PositiveBigIntegerField()
+    generation = models.ForeignKey(Generation, on_delete=models.CASCADE)
+    areas = ArrayField(models.IntegerField())
+
+    objects = UPRNAssignmentManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["uprn", "generation"],
+                name="mapit_labour_uprnassignment_unique",
+            ),
+        ]
+        indexes = [GinIndex(name="mapit_labour_assignment_areas", fields=["areas"])]
+        verbose_name = "UPRN assignment"
+
+    def __str__(self):
+        return f"{self.uprn} ({self.generation_id})"
+
+
 # Taken from https://github.com/mysociety/mapit.mysociety.org, sans-Redis bits
 class APIKey(models.Model):
     user = models.ForeignKey(
@@ -115,3 +500,127 @@ def create_key_for_new_user(sender, **kwargs):
         pass
 
     APIKey.objects.create(user=user, key=APIKey.generate_key())
+
+
+@receiver(models.signals.post_save, sender=Generation)
+def invalidate_cache_for_generation_change(sender, **kwargs):
+    """Cached UPRN lookups may depend on which generation is current."""
+    invalidate_all()
+
+
+@receiver(models.signals.pre_save, sender=Generation)
+def note_generation_active(sender, instance, raw=False, **kwargs):
+    instance._was_active = (
+        not raw
+        and instance.pk is not None
+        and Generation.objects.filter(pk=instance.pk, active=True).exists()
+    )
+
+
+@receiver(models.signals.post_save, sender=Generation)
+def clear_assignments_for_activated_generation(sender, instance, raw=False, **kwargs):
+    """
+    Any assignments a newly activated generation already has were only
+    built for the UPRNs changed by imports into it, and won't reflect later
+    changes to its areas, so they're deleted and lookups fall back to the
+    spatial query until mapit_labour_build_uprn_assignments is run.
+    """
+    if raw or not instance.active or getattr(instance, "_was_active", False):
+        return
+    if Generation.objects.current() == instance:
+        UPRNAssignment.objects.filter(generation=instance).delete()
+
+
+@receiver(models.signals.post_save, sender=Area)
+@receiver(models.signals.post_delete, sender=Area)
+def invalidate_cache_for_area_change(sender, **kwargs):
+    """Cached UPRN lookups may include this area."""
+    invalidate_all()
+
+
+class AreaChanges(set):
+    """
+    The IDs of the areas changed in a transaction whose assignments in the
+    current generation are to be rebuilt when it commits, so all the changes
+    made in it (e.g. by an import) are handled together. It's registered
+    with on_commit, so it's discarded along with the transaction if that's
+    rolled back.
+    """
+
+    def __init__(self, generation):
+        super().__init__()
+        self.generation = generation
+        self.done = False
+
+    @classmethod
+    def pending(cls, generation):
+        """The AreaChanges for generation registered in this transaction, if any."""
+        for callback in connection.run_on_commit:
+            func = callback[1]
+            if isinstance(func, cls) and not func.done:
+                return func if func.generation == generation else None
+        return None
+
+    @classmethod
+    def add_area(cls, generation, area_id):
+        if (changes := cls.pending(generation)) is None:
+            changes = cls(generation)
+            changes.add(area_id)
+            # This runs straight away outside a transaction
+            transaction.on_commit(changes)
+        else:
+            changes.add(area_id)
+
+    def __call__(self):
+        self.done = True
+        if self:
+            with transaction.atomic():
+                UPRNAssignment.objects.refresh(self.generation, areas=set(self))
+            # Responses may have been cached from the old assignments meanwhile
+            invalidate_all()
+
+
+def covers_generation(area, generation):
+    return (
+        (area.generation_low_id or 0) <= generation.id <= (area.generation_high_id or 0)
+    )
+
+
+def is_assigned(area_id, generation):
+    return UPRNAssignment.objects.filter(
+        generation=generation, areas__contains=[area_id]
+    ).exists()
+
+
+@receiver(models.signals.post_save, sender=Area)
+def refresh_assignments_for_area_save(sender, instance, raw=False, **kwargs):
+    """
+    An area's assignments in the current generation only need rebuilding if
+    it's moved into or out of the generation. Other changes, like its name,
+    or extending it to a new generation, don't affect them.
+    """
+    if raw or not (current := Generation.objects.current()):
+        return
+    if covers_generation(instance, current) != is_assigned(instance.id, current):
+        AreaChanges.add_area(current, instance.id)
+
+
+@receiver(models.signals.post_delete, sender=Area)
+def refresh_assignments_for_area_delete(sender, instance, **kwargs):
+    if (current := Generation.objects.current()) and is_assigned(instance.id, current):
+        AreaChanges.add_area(current, instance.id)
+
+
+@receiver(models.signals.post_save, sender=Geometry)
+@receiver(models.signals.post_delete, sender=Geometry)
+def refresh_assignments_for_geometry_change(sender, instance, raw=False, **kwargs):
+    """Rebuild the assignments of an area in the current generation whose geometry changes."""
+    if raw or not (current := Generation.objects.current()):
+        return
+    try:
+        affected = covers_generation(instance.area, current)
+    except Area.DoesNotExist:
+        # Deleted along with its area
+        affected = is_assigned(instance.area_id, current)
+    if affected:
+        AreaChanges.add_area(current, instance.area_id)
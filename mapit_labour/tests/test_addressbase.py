@@ -0,0 +1,101 @@
+import json
+
+from django.test import SimpleTestCase, TestCase
+from django.contrib.gis.geos import Point
+
+from mapit_labour.addressbase import (
+    FIELDS,
+    build_record,
+    jsonb_key_order,
+    split_record,
+)
+from mapit_labour.models import UPRN
+
+
+class AddressBaseRecordTests(SimpleTestCase):
+    record = {
+        **dict.fromkeys(FIELDS, ""),
+        "uprn": "77281020",
+        "udprn": "1309123",
+        "usrn": "12309821",
+        "toid": "osgb1000012345678",
+        "classification_code": "RD",
+        "easting": "297350",
+        "northing": "92996",
+        "last_update_date": "2020-01-06",
+        "single_line_address": "13 TEST STREET, TESTVILLE, TE1 5TT",
+        "building_number": "13",
+        "street_name": "TEST STREET",
+        "town_name": "TESTVILLE",
+        "postcode": "TE1 5TT",
+    }
+
+    def test_split_record(self):
+        columns, extra = split_record(self.record)
+        self.assertEqual(columns["usrn"], 12309821)
+        self.assertIsNone(columns["parent_uprn"])
+        self.assertEqual(columns["postcode"], "TE15TT")
+        self.assertEqual(columns["last_update_date"].isoformat(), "2020-01-06")
+        # Empty fields and those stored in columns aren't kept
+        self.assertEqual(
+            extra,
+            {
+                "easting": "297350",
+                "northing": "92996",
+                "building_number": "13",
+                "street_name": "TEST STREET",
+                "town_name": "TESTVILLE",
+            },
+        )
+
+    def test_build_record(self):
+        record = build_record(*split_record(self.record))
+        self.assertEqual(record, self.record)
+        # Keys are in the same order as PostgreSQL outputs JSONB objects
+        self.assertEqual(list(record), sorted(self.record, key=jsonb_key_order))
+        self.assertEqual(list(record)[:4], ["rpc", "toid", "uprn", "usrn"])
+
+    def test_values_that_columns_cant_store(self):
+        record = {
+            **self.record,
+            "usrn": "012309821",
+            "last_update_date": "2020-02-30",
+            "postcode": "TE15TT",
+            "not_a_field": "",
+        }
+        columns, extra = split_record(record)
+        self.assertIsNone(columns["usrn"])
+        self.assertIsNone(columns["last_update_date"])
+        self.assertEqual(extra["usrn"], "012309821")
+        self.assertEqual(extra["last_update_date"], "2020-02-30")
+        self.assertEqual(extra["postcode"], "TE15TT")
+        self.assertEqual(extra["not_a_field"], "")
+        self.assertEqual(
+            json.dumps(build_record(columns, extra)),
+            json.dumps({k: record[k] for k in sorted(record, key=jsonb_key_order)}),
+        )
+
+
+class AddressBaseLookupTests(TestCase):
+    def test_lookup_values_kept_in_extra(self):
+        for uprn, postcode in [(1, "TE1 5TT"), (2, "TE15TT")]:
+            columns, extra = split_record(
+                {"uprn": str(uprn), "postcode": postcode, "usrn": "", "toid": "x"}
+            )
+            UPRN.objects.create(
+                location=Point(0, 0, srid=27700),
+                addressbase_extra=extra,
+                **columns,
+            )
+
+        def lookup(**kwargs):
+            return list(
+                UPRN.objects.addressbase_lookup(kwargs).values_list("uprn", flat=True)
+            )
+
+        self.assertEqual(lookup(postcode="TE1 5TT"), [1])
+        self.assertEqual(lookup(postcode="TE15TT"), [2])
+        self.assertEqual(lookup(usrn=""), [1, 2])
+        self.assertEqual(lookup(toid="x", island=""), [1, 2])
+        self.assertEqual(lookup(toid="y"), [])
+        self.assertEqual(UPRN.objects.get(uprn=2).addressbase["postcode"], "TE15TT")
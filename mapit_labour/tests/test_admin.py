@@ -2,6 +2,9 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 from pprint import pprint
 
+from mapit_labour.admin import LargeTablePaginator
+from mapit_labour.models import UPRN
+
 from .utils import LoadTestData
 
 
@@ -35,3 +38,10 @@ class UPRNAdminTestCase(LoadTestData, TestCase):
             """<a href="/uprn/77281020.html" class="viewsitelink">View on site</a>""",
             resp.content.decode(),
         )
+        self.assertContains(resp, "&quot;usrn&quot;: &quot;12309821&quot;")
+
+    def test_uprn_count_estimate(self):
+        # The estimate for the partitioned table is the sum of its partitions',
+        # which the import refreshes
+        paginator = LargeTablePaginator(UPRN.objects.all(), 25)
+        self.assertEqual(paginator.count, UPRN.objects.count())
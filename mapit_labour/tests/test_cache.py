@@ -0,0 +1,28 @@
+from django.test import TestCase
+
+from mapit.models import Area
+from mapit.views.areas import add_codes
+
+from mapit_labour.cache import AreaCache
+
+
+class AreaCacheTestCase(TestCase):
+    fixtures = ["uk", "test_areas"]
+
+    def setUp(self):
+        self.cache = AreaCache(lambda ids: add_codes(Area.objects.filter(id__in=ids)))
+
+    def names(self, ids):
+        return [area["name"] for area in self.cache.get_many(ids)]
+
+    def test_areas_cached(self):
+        self.assertEqual(self.names([1, 999]), ["WMC Area A"])
+        # Neither the existing nor the missing area are looked up again
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names([1, 999]), ["WMC Area A"])
+            self.assertEqual(self.names([1]), ["WMC Area A"])
+
+    def test_areas_in_default_order(self):
+        ids = list(Area.objects.values_list("id", flat=True))
+        expected = [area.name for area in Area.objects.filter(id__in=ids)]
+        self.assertEqual(self.names(ids[::-1]), expected)
@@ -1,11 +1,19 @@
+import csv
+import tempfile
 from io import StringIO
 from pathlib import Path
 
 from django.conf import settings
 from django.contrib.gis.geos import Point
+from django.core.cache import cache
 from django.core.management import call_command
-from django.test import TestCase
-from mapit_labour.models import UPRN
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase, override_settings
+from mapit_labour.addressbase import split_record
+from mapit_labour.cache import UPRN_VERSION_KEY
+from mapit_labour.models import UPRN, UPRNAssignment
+
+from .utils import LoadTestData
 
 
 class AddressBaseImportTest(TestCase):
@@ -33,6 +41,8 @@ class AddressBaseImportTest(TestCase):
         self.assertEqual(uprn.postcode, "TE15TT")
         self.assertEqual(uprn.single_line_address, "13 TEST STREET, TESTVILLE, TE1 5TT")
         self.assertEqual(uprn.location, Point(297350, 92996, srid=27700))
+        self.assertAlmostEqual(uprn.wgs84_lat, 50.72748566697889, delta=0.00002)
+        self.assertAlmostEqual(uprn.wgs84_lon, -3.455734399454025, delta=0.00002)
         self.assertDictEqual(
             uprn.addressbase,
             {
@@ -67,6 +77,38 @@ class AddressBaseImportTest(TestCase):
         )
         self.assertEqual(UPRN.objects.get(uprn=9913912312).postcode, "TE57TT")
 
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_only_updated_uprns_invalidated(self):
+        fixtures_dir = Path(settings.BASE_DIR) / "mapit_labour" / "tests" / "fixtures"
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                "mapit_labour_import_addressbase_core",
+                fixtures_dir / "addressbase-core-tiny.csv",
+                stderr=StringIO(),
+                stdout=StringIO(),
+                purge=True,
+            )
+        self.assertEqual(cache.get_many([UPRN_VERSION_KEY % 77281020]), {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                "mapit_labour_import_addressbase_core",
+                fixtures_dir / "addressbase-core-update.csv",
+                stderr=StringIO(),
+                stdout=StringIO(),
+            )
+        # 77281020 is updated, 123891 is created and 9913912312 is unchanged
+        self.assertEqual(
+            set(
+                cache.get_many(
+                    [UPRN_VERSION_KEY % uprn for uprn in (77281020, 123891, 9913912312)]
+                )
+            ),
+            {UPRN_VERSION_KEY % 77281020},
+        )
+
     def test_load_addressbase_csv_update(self):
         self.assertEqual(UPRN.objects.count(), 0)
 
@@ -176,3 +218,151 @@ class AddressBaseImportTest(TestCase):
             UPRN.DoesNotExist, msg="Row with new UPRN was ignored as it was too old"
         ):
             UPRN.objects.get(uprn=123890)
+
+    def test_load_addressbase_csv_cluster(self):
+        fixtures_dir = Path(settings.BASE_DIR) / "mapit_labour" / "tests" / "fixtures"
+        stdout = StringIO()
+        call_command(
+            "mapit_labour_import_addressbase_core",
+            fixtures_dir / "addressbase-core-tiny.csv",
+            purge=True,
+            cluster=True,
+            stderr=StringIO(),
+            stdout=stdout,
+        )
+
+        self.assertIn("Clustered 16/16 partitions", stdout.getvalue())
+        self.assertEqual(UPRN.objects.count(), 2)
+        self.assertEqual(UPRN.objects.get(uprn=77281020).postcode, "TE15TT")
+
+
+class ParallelAddressBaseImportTest(TransactionTestCase):
+    """
+    Test mapit_labour_import_addressbase_core with --workers, whose worker
+    processes have their own connections so can't see a test transaction.
+    """
+
+    def test_load_addressbase_csv_parallel(self):
+        fixtures_dir = Path(settings.BASE_DIR) / "mapit_labour" / "tests" / "fixtures"
+        call_command(
+            "mapit_labour_import_addressbase_core",
+            fixtures_dir / "addressbase-core-tiny.csv",
+            purge=True,
+            workers=2,
+            batch_size=1,
+            stderr=StringIO(),
+            stdout=StringIO(),
+        )
+        stdout = StringIO()
+        call_command(
+            "mapit_labour_import_addressbase_core",
+            fixtures_dir / "addressbase-core-update.csv",
+            workers=2,
+            stderr=StringIO(),
+            stdout=stdout,
+        )
+
+        self.assertIn("1 created, 1 updated, 3 total", stdout.getvalue())
+        self.assertEqual(UPRN.objects.count(), 3)
+        self.assertEqual(UPRN.objects.get(uprn=77281020).postcode, "TE15TZ")
+
+    def test_load_addressbase_csv_parallel_dry_run(self):
+        fixtures_dir = Path(settings.BASE_DIR) / "mapit_labour" / "tests" / "fixtures"
+        stdout = StringIO()
+        call_command(
+            "mapit_labour_import_addressbase_core",
+            fixtures_dir / "addressbase-core-tiny.csv",
+            workers=2,
+            dry_run=True,
+            stderr=StringIO(),
+            stdout=stdout,
+        )
+
+        self.assertIn("2 created, 0 updated, 2 total", stdout.getvalue())
+        self.assertEqual(UPRN.objects.count(), 0)
+
+
+class BuildUPRNAssignmentsTest(LoadTestData, TestCase):
+    """Test the mapit_labour_build_uprn_assignments management command"""
+
+    fixtures = ["uk", "test_areas"]
+
+    def test_build_assignments(self):
+        UPRNAssignment.objects.all().delete()
+
+        stdout = StringIO()
+        call_command("mapit_labour_build_uprn_assignments", stdout=stdout)
+
+        self.assertIn("Assigned 2 UPRNs in generation 1", stdout.getvalue())
+        self.assertEqual(
+            dict(UPRNAssignment.objects.values_list("uprn", "areas")),
+            {77281020: [1], 9913912312: []},
+        )
+
+
+class BenchmarkTest(LoadTestData, TestCase):
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command("mapit_labour_benchmark", repeat=1, rows=1000, stdout=stdout)
+        self.assertIn("addressbase_lookup:", stdout.getvalue())
+        self.assertIn("usrn", stdout.getvalue())
+        self.assertIn("mapit_labour_uprn", stdout.getvalue())
+        self.assertIn("pages/row", stdout.getvalue())
+        self.assertIn("speedup", stdout.getvalue())
+        self.assertRegex(stdout.getvalue(), r"identical +yes")
+        self.assertIn("encode", stdout.getvalue())
+
+    def test_unknown_benchmark(self):
+        with self.assertRaises(CommandError):
+            call_command("mapit_labour_benchmark", "nonsense", stdout=StringIO())
+
+
+class MatchAddressesTest(LoadTestData, TestCase):
+    def test_match_addresses(self):
+        # A record with no building fields in the same postcode as row 1
+        columns, extra = split_record(
+            {
+                "uprn": "1",
+                "postcode": "TE1 5TT",
+                "single_line_address": "PO BOX 99, TESTVILLE, TE1 5TT",
+                "po_box": "99",
+            }
+        )
+        UPRN.objects.create(
+            location=Point(0, 0, srid=27700), addressbase_extra=extra, **columns
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            infile = Path(tmp) / "members.csv"
+            infile.write_text(
+                "id,address\n"
+                '1,"13, Test St., Testville TE1 5TT"\n'
+                "2,El Capitan Crockery Zettabyte Road te57tt\n"
+                "3,Somewhere with no postcode\n"
+                '4,"1 Other Street, TE9 9ZZ"\n'
+            )
+            stdout = StringIO()
+            call_command(
+                "mapit_labour_match_addresses",
+                str(infile),
+                batch_size=2,
+                stdout=stdout,
+                stderr=StringIO(),
+            )
+        rows = list(csv.DictReader(StringIO(stdout.getvalue())))
+        self.assertEqual(
+            [(row["id"], row["uprn"]) for row in rows],
+            [("1", "77281020"), ("2", "9913912312"), ("3", ""), ("4", "")],
+        )
+        self.assertEqual(
+            rows[0]["matched_address"], "13 TEST STREET, TESTVILLE, TE1 5TT"
+        )
+        self.assertGreater(float(rows[0]["match_score"]), 0.5)
+        self.assertEqual(rows[2]["match_score"], "")
+
+    def test_missing_address_column(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write("id,addr\n1,13 Test Street TE1 5TT\n")
+            f.flush()
+            with self.assertRaises(CommandError):
+                call_command("mapit_labour_match_addresses", f.name, stdout=StringIO())
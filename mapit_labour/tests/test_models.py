@@ -20,3 +20,35 @@ class UPRNTests(LoadTestData, TestCase):
     def test_urpn(self):
         uprn = UPRN.objects.get(uprn=77281020)
         self.assertEqual(str(uprn), "77281020")
+
+    def test_uprn_as_dict_uses_stored_wgs84(self):
+        uprn = UPRN.objects.get(uprn=77281020)
+        with self.assertNumQueries(0):
+            d = uprn.as_dict()
+        self.assertEqual(d["wgs84_lon"], uprn.wgs84_lon)
+        self.assertEqual(d["wgs84_lat"], uprn.wgs84_lat)
+
+    def test_uprn_as_dict_with_addressbase_fields(self):
+        uprn = UPRN.objects.with_addressbase_fields(
+            ["postcode", "single_line_address"]
+        ).get(uprn=77281020)
+        with self.assertNumQueries(0):
+            d = uprn.as_dict()
+        self.assertEqual(
+            d["addressbase_core"],
+            {
+                "postcode": "TE1 5TT",
+                "single_line_address": "13 TEST STREET, TESTVILLE, TE1 5TT",
+            },
+        )
+
+    def test_uprn_rows(self):
+        uprns = UPRN.objects.order_by("uprn")
+        with self.assertNumQueries(1):
+            rows = list(uprns.rows())
+        self.assertEqual([row.as_dict() for row in rows], [u.as_dict() for u in uprns])
+        self.assertEqual(rows[0].as_dict(skip_location=True), uprns[0].as_dict(True))
+
+    def test_uprn_rows_with_addressbase_fields(self):
+        (row,) = UPRN.objects.filter(uprn=77281020).rows(["postcode", "usrn"])
+        self.assertEqual(row.addressbase, {"postcode": "TE1 5TT", "usrn": "12309821"})
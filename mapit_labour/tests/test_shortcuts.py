@@ -0,0 +1,51 @@
+import json
+
+from django.test import SimpleTestCase, TestCase
+
+from mapit.shortcuts import GEOS_JSONEncoder
+
+from mapit_labour.models import UPRN
+from mapit_labour.shortcuts import RawJSON, encode_json, output_json
+
+from .utils import LoadTestData
+
+
+class EncodeJSONTests(SimpleTestCase):
+    def test_encode_json(self):
+        record = {"name": 'Café "Crockery"\n', "number": "\\13"}
+        out = {
+            "uprn": 1,
+            "addressbase_core": RawJSON(json.dumps(record, ensure_ascii=False)),
+            "areas": [RawJSON("[]"), 2.5],
+        }
+        self.assertEqual(
+            encode_json(out),
+            json.dumps(
+                {"uprn": 1, "addressbase_core": record, "areas": [[], 2.5]},
+                ensure_ascii=False,
+            ),
+        )
+
+    def test_output_json(self):
+        response = output_json({"error": "Not found"}, code=404)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response["Access-Control-Allow-Origin"], "*")
+        self.assertEqual(response.content, b'{"error": "Not found", "code": 404}')
+
+
+class RawRecordTests(LoadTestData, TestCase):
+    def assertSameOutput(self, fields):
+        encoder = GEOS_JSONEncoder(ensure_ascii=False)
+        uprns = UPRN.objects.order_by("uprn")
+        self.assertEqual(
+            encode_json([uprn.as_dict() for uprn in uprns.rows(fields, raw=True)]),
+            encoder.encode(
+                [uprn.as_dict() for uprn in uprns.with_addressbase_fields(fields)]
+            ),
+        )
+
+    def test_raw_records(self):
+        self.assertSameOutput(None)
+
+    def test_raw_record_fields(self):
+        self.assertSameOutput(["postcode", "usrn", "organisation", "building_name"])
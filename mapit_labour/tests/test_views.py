@@ -1,4 +1,7 @@
+import csv
 import json
+import re
+import time
 
 # Quieten down Django logs, as various errors are deliberately raised
 import logging
@@ -8,7 +11,10 @@ logging.disable(logging.CRITICAL)
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import Polygon
 from django.test import TestCase, override_settings
+from django.utils.http import parse_http_date
 from mapit.models import Area, Generation, Geometry, Type
+from mapit_labour.cache import invalidate_all, invalidate_uprns
+from mapit_labour.models import UPRN, UPRNAssignment
 
 from .utils import LoadTestData
 
@@ -214,6 +220,93 @@ class UPRNLookupTestCase(LoadTestData, TestCase):
         self.assertInHTML("<h2>UPRN: 77281020</h2>", html)
         self.assertInHTML("<li>OSGB E/N: 297350.0, 92996.0</li>", html)
 
+    def test_uprn_uses_assignments(self):
+        self.assertEqual(
+            list(
+                UPRNAssignment.objects.filter(uprn=77281020).values_list(
+                    "generation", "areas"
+                )
+            ),
+            [(1, [1])],
+        )
+        with_assignment = json.loads(self.client.get("/uprn/77281020.json").content)
+
+        # Falls back to the spatial query if there's no assignment
+        UPRNAssignment.objects.all().delete()
+        without_assignment = json.loads(self.client.get("/uprn/77281020.json").content)
+        self.assertEqual(with_assignment, without_assignment)
+        self.assertEqual(with_assignment["shortcuts"], {"WMC": 1})
+
+    def test_assignments_refreshed_for_geometry_change(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Geometry.objects.filter(area_id=1).delete()
+        self.assertEqual(
+            list(UPRNAssignment.objects.filter(uprn=77281020).values_list("areas")),
+            [([],)],
+        )
+        response = json.loads(self.client.get("/uprn/77281020.json").content)
+        self.assertEqual(response["areas"], {})
+
+    def test_assignments_not_refreshed_for_other_generations(self):
+        new = Generation.objects.create(active=False, description="new")
+        Area.objects.filter(id=1).update(generation_low=new, generation_high=new)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Geometry.objects.filter(area_id=1).delete()
+        self.assertEqual(callbacks, [])
+
+    def test_assignments_deleted_on_activation(self):
+        generation = Generation.objects.create(active=False, description="new")
+        UPRNAssignment.objects.create(uprn=77281020, generation=generation, areas=[])
+        generation.active = True
+        generation.save()
+        self.assertFalse(UPRNAssignment.objects.filter(generation=generation).exists())
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_uprn_response_cached(self):
+        url = "/uprn/77281020.json"
+        first = self.client.get(url).content
+        self.assertIn(b"WMC Area A", first)
+
+        # Changes that don't go through an import aren't seen...
+        Area.objects.filter(id=1).update(name="WMC Area Renamed")
+        self.assertEqual(self.client.get(url).content, first)
+        # ...and nor are they for other query args
+        self.assertIn(b"WMC Area Renamed", self.client.get(url + "?type=WMC").content)
+
+        invalidate_uprns([77281020])
+        self.assertIn(b"WMC Area Renamed", self.client.get(url).content)
+
+        Area.objects.filter(id=1).update(name="WMC Area Renamed Again")
+        invalidate_all()
+        self.assertIn(b"WMC Area Renamed Again", self.client.get(url).content)
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_uprn_conditional_get(self):
+        url = "/uprn/77281020.json"
+        invalidate_all()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        # The invalidation token is from just now, whatever the time zone
+        modified = parse_http_date(response["Last-Modified"])
+        self.assertAlmostEqual(modified, time.time(), delta=60)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Other query args have their own validators
+        response = self.client.get(url + "?type=WMC", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        invalidate_uprns([77281020])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
     def test_missing_uprn(self):
         for url in (
             f"/uprn/123098123.html",
@@ -223,6 +316,160 @@ class UPRNLookupTestCase(LoadTestData, TestCase):
             self.assertEqual(self.client.get(url).status_code, 404)
 
 
+class UPRNBatchLookupTestCase(LoadTestData, TestCase):
+    fixtures = ["uk", "test_areas"]
+
+    def setUp(self):
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def test_batch_lookup(self):
+        resp = self.client.post(
+            "/uprns",
+            json.dumps([77281020, 9913912312, 123098123]),
+            content_type="application/json",
+        )
+        self.assertEqual(resp.status_code, 200)
+        response = json.loads(unstream(resp))
+        self.assertEqual(set(response.keys()), {"77281020", "9913912312"})
+
+        single = json.loads(self.client.get("/uprn/77281020.json").content)
+        batch = response["77281020"]
+        self.assertAlmostEqual(batch.pop("wgs84_lat"), single.pop("wgs84_lat"))
+        self.assertAlmostEqual(batch.pop("wgs84_lon"), single.pop("wgs84_lon"))
+        self.assertEqual(batch, single)
+
+        self.assertEqual(response["9913912312"]["areas"], {})
+        self.assertNotIn("shortcuts", response["9913912312"])
+
+    def test_batch_lookup_form_encoded(self):
+        resp = self.client.post("/uprns", {"uprns": "77281020,9913912312"})
+        response = json.loads(unstream(resp))
+        self.assertEqual(response["77281020"]["shortcuts"], {"WMC": 1})
+        self.assertEqual(set(response.keys()), {"77281020", "9913912312"})
+
+    def test_batch_lookup_invalid(self):
+        for body in ("[]", '["abc"]', '{"uprns": 1}', "nonsense"):
+            resp = self.client.post("/uprns", body, content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(self.client.get("/uprns").status_code, 405)
+
+    @override_settings(UPRN_BATCH_LIMIT=1)
+    def test_batch_lookup_limit(self):
+        resp = self.client.post(
+            "/uprns",
+            json.dumps([77281020, 9913912312]),
+            content_type="application/json",
+        )
+        self.assertEqual(resp.status_code, 400)
+
+
+class PostcodeUPRNsTestCase(LoadTestData, TestCase):
+    fixtures = ["uk", "test_areas"]
+
+    def setUp(self):
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def test_postcode_uprns(self):
+        for url in (
+            "/postcode/TE15TT/uprns",
+            "/postcode/te1 5tt/uprns.json",
+            "/postcode/TE1+5TT/uprns",
+        ):
+            response = json.loads(unstream(self.client.get(url)))
+            self.assertEqual([u["uprn"] for u in response], [77281020])
+            self.assertEqual(
+                response[0]["addressbase_core"]["single_line_address"],
+                "13 TEST STREET, TESTVILLE, TE1 5TT",
+            )
+            self.assertNotIn("areas", response[0])
+
+        self.assertEqual(
+            json.loads(unstream(self.client.get("/postcode/ZZ99ZZ/uprns"))), []
+        )
+
+    def test_postcode_uprns_with_areas(self):
+        response = json.loads(
+            unstream(self.client.get("/postcode/TE15TT/uprns?areas=1"))
+        )
+        self.assertEqual(response[0]["areas"], [1])
+        self.assertEqual(response[0]["shortcuts"], {"WMC": 1})
+
+    def test_postcode_uprns_html(self):
+        self.assertContains(
+            self.client.get("/postcode/TE57TT/uprns.html"),
+            "EL CAPITAN CROCKERY, 37 ZETTABYTE ROAD, TESTVILLE, TE5 7TT",
+        )
+
+
+class AreaUPRNsTestCase(LoadTestData, TestCase):
+    fixtures = ["uk", "test_areas"]
+
+    def setUp(self):
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def test_area_uprns_ndjson(self):
+        resp = self.client.get("/area/1/uprns")
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+        lines = unstream(resp).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        uprn = json.loads(lines[0])
+        self.assertEqual(uprn["uprn"], 77281020)
+        self.assertEqual(uprn["postcode"], "TE15TT")
+        self.assertEqual(uprn["easting"], 297350.0)
+        self.assertEqual(uprn["addressbase_core"]["street_name"], "TEST STREET")
+
+    def test_area_uprns_csv(self):
+        resp = self.client.get("/area/1/uprns.csv")
+        self.assertEqual(resp["Content-Type"], "text/csv")
+        rows = list(csv.reader(unstream(resp).decode().splitlines()))
+        self.assertEqual(
+            rows[0],
+            [
+                "uprn",
+                "postcode",
+                "easting",
+                "northing",
+                "wgs84_lon",
+                "wgs84_lat",
+                "single_line_address",
+            ],
+        )
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][:4], ["77281020", "TE15TT", "297350.0", "92996.0"])
+        self.assertEqual(rows[1][6], "13 TEST STREET, TESTVILLE, TE1 5TT")
+
+    def test_missing_area(self):
+        self.assertEqual(self.client.get("/area/999/uprns").status_code, 404)
+
+
+class PointUPRNsTestCase(LoadTestData, TestCase):
+    def setUp(self):
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def test_nearest_uprns(self):
+        response = json.loads(
+            unstream(self.client.get("/point/27700/297351,92997/uprns"))
+        )
+        self.assertEqual([u["uprn"] for u in response], [77281020, 9913912312])
+        self.assertAlmostEqual(response[0]["distance"], 2**0.5)
+
+        response = json.loads(
+            unstream(self.client.get("/point/27700/296121,96111/uprns.json?count=1"))
+        )
+        self.assertEqual([u["uprn"] for u in response], [9913912312])
+
+    def test_nearest_uprns_wgs84(self):
+        response = json.loads(
+            unstream(self.client.get("/point/4326/-3.4557,50.7275/uprns?count=1"))
+        )
+        self.assertEqual([u["uprn"] for u in response], [77281020])
+
+    def test_bad_count(self):
+        resp = self.client.get("/point/27700/297351,92997/uprns?count=lots")
+        self.assertEqual(resp.status_code, 400)
+
+
 class AddressBaseTestCase(LoadTestData, TestCase):
     maxDiff = None
 
@@ -317,6 +564,99 @@ class AddressBaseTestCase(LoadTestData, TestCase):
                 [self._uprn2],
             )
 
+    def test_indexed_fields_lookup(self):
+        for q, expected in [
+            ("uprn=9913912312", [self._uprn2]),
+            ("uprn=nonsense", []),
+            ("postcode=te1+5tt", [self._uprn1]),
+            ("postcode=te15tt", []),
+            ("usrn=14200020", [self._uprn2]),
+            ("parent_uprn=13098123", [self._uprn2]),
+            ("toid=osgb1000012345678", [self._uprn1]),
+            ("toid=OSGB1000012345678", [self._uprn1]),
+            ("usrn=12309821&town_name=testville", [self._uprn1]),
+            ("usrn=12309821&classification_code=co", []),
+        ]:
+            self.assertJSONEqual(
+                unstream(self.client.get(f"/addressbase?{q}")), expected
+            )
+
+    def test_ranked_search(self):
+        results = json.loads(
+            unstream(self.client.get("/addressbase?q=13+test+stret+testvile"))
+        )
+        self.assertEqual(results[0]["uprn"], "77281020")
+        self.assertGreater(results[0]["score"], 0.5)
+        self.assertEqual(
+            [r["score"] for r in results],
+            sorted([r["score"] for r in results], reverse=True),
+        )
+
+        # Other filters still apply
+        self.assertJSONEqual(
+            unstream(self.client.get("/addressbase?q=13+test+street&usrn=14200020")),
+            [],
+        )
+        self.assertJSONEqual(
+            unstream(self.client.get("/addressbase?q=nothing+like+it")), []
+        )
+
+    def test_fields(self):
+        fields = ["uprn", "postcode", "single_line_address"]
+        self.assertJSONEqual(
+            unstream(
+                self.client.get(
+                    "/addressbase?town_name=testville&fields=uprn,postcode,single_line_address"
+                )
+            ),
+            [
+                {field: self._uprn1[field] for field in fields},
+                {field: self._uprn2[field] for field in fields},
+            ],
+        )
+
+        results = json.loads(
+            unstream(self.client.get("/addressbase?q=13+test+street&fields=uprn"))
+        )
+        self.assertEqual(set(results[0]), {"uprn", "score"})
+
+        resp = self.client.get("/addressbase?town_name=testville&fields=uprn,nonsense")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_streaming(self):
+        url = "/addressbase?town_name=testville"
+        streamed = self.client.get(url + "&stream=1")
+        self.assertTrue(streamed.streaming)
+        self.assertEqual(unstream(streamed), unstream(self.client.get(url)))
+        self.assertEqual(
+            unstream(self.client.get("/addressbase?town_name=nowhere&stream=1")),
+            b"[]",
+        )
+
+    @override_settings(ADDRESSBASE_STREAMING_RESULTS_LIMIT=1)
+    def test_streaming_limit(self):
+        self.assertJSONEqual(
+            unstream(self.client.get("/addressbase?town_name=testville&stream=1")),
+            [self._uprn1],
+        )
+
+    def test_area_lookup(self):
+        self.assertJSONEqual(
+            unstream(self.client.get("/addressbase?town_name=testville&area=1")),
+            [self._uprn1],
+        )
+        self.assertJSONEqual(
+            unstream(self.client.get("/addressbase?usrn=14200020&area=1")), []
+        )
+        self.assertEqual(
+            self.client.get("/addressbase?town_name=testville&area=999").status_code,
+            404,
+        )
+        self.assertEqual(
+            self.client.get("/addressbase?town_name=testville&area=x").status_code,
+            400,
+        )
+
     @override_settings(ADDRESSBASE_RESULTS_LIMIT=1)
     def test_limiting_result_count(self):
         self.assertJSONEqual(
@@ -324,6 +664,36 @@ class AddressBaseTestCase(LoadTestData, TestCase):
             [self._uprn1],
         )
 
+    @override_settings(ADDRESSBASE_RESULTS_LIMIT=1)
+    def test_pagination(self):
+        response = self.client.get("/addressbase?town_name=testville")
+        self.assertJSONEqual(unstream(response), [self._uprn1])
+        match = re.fullmatch(r'<http://testserver(.*)>; rel="next"', response["Link"])
+        self.assertIn("town_name=testville", match.group(1))
+
+        response = self.client.get(match.group(1))
+        self.assertJSONEqual(unstream(response), [self._uprn2])
+        self.assertNotIn("Link", response)
+
+        response = self.client.get("/addressbase?town_name=testville&cursor=!!")
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_conditional_get(self):
+        url = "/addressbase?town_name=testville"
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+        # Validators are used alongside the usual max-age
+        self.assertEqual(response["Cache-Control"], "max-age=2419200")
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # An import changing any UPRN changes the validators
+        invalidate_uprns([77281020])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
     def test_single_line_address_lookup(self):
         pass
         # test that addressbase lookup works for single_line_address
@@ -342,6 +712,47 @@ class AddressBaseTestCase(LoadTestData, TestCase):
         # test that addressbase non-matching params returns no results
 
 
+class AutocompleteTestCase(LoadTestData, TestCase):
+    def setUp(self):
+        self.assertTrue(self.client.login(username="testuser", password="password"))
+
+    def suggest(self, q):
+        return json.loads(
+            unstream(self.client.get("/addressbase/autocomplete", {"q": q}))
+        )
+
+    def test_autocomplete(self):
+        self.assertEqual(
+            self.suggest("13 test"),
+            [
+                {
+                    "uprn": 77281020,
+                    "single_line_address": "13 TEST STREET, TESTVILLE, TE1 5TT",
+                }
+            ],
+        )
+        self.assertEqual([s["uprn"] for s in self.suggest("te5 7")], [9913912312])
+        self.assertEqual([s["uprn"] for s in self.suggest("El  Capitan")], [9913912312])
+        self.assertEqual(self.suggest("13 nowhere"), [])
+        # Too short to make suggestions for
+        self.assertEqual(self.suggest("13"), [])
+
+    def test_autocomplete_max_age(self):
+        response = self.client.get("/addressbase/autocomplete", {"q": "13 test"})
+        self.assertEqual(response["Cache-Control"], "max-age=300")
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_autocomplete_cached(self):
+        self.assertEqual(len(self.suggest("13 test")), 1)
+        UPRN.objects.filter(uprn=77281020).delete()
+        self.assertEqual(len(self.suggest("13 test")), 1)
+
+        invalidate_uprns([77281020])
+        self.assertEqual(self.suggest("13 test"), [])
+
+
 def unstream(response):
     # Convert the content of a StreamingHttpResponse back to a single bytestring
     return b"".join(response.streaming_content)
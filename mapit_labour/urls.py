@@ -2,7 +2,12 @@ from django.urls import re_path, path
 
 from mapit_labour.views import (
     uprn,
+    uprns,
+    postcode_uprns,
+    area_uprns,
+    point_uprns,
     addressbase,
+    autocomplete,
     health_check,
     import_csv,
     import_csv_status,
@@ -11,10 +16,28 @@ from mapit_labour.views import (
 
 
 format_end = r"(?:\.(?P<format>html|json))?"
+number = r"-?\d*\.?\d+"
 
 urlpatterns = [
     re_path(r"^uprn/(?P<uprn>[0-9]+)%s$" % format_end, uprn, name="mapit_labour-uprn"),
+    path("uprns", uprns, name="mapit_labour-uprns"),
+    re_path(
+        r"^postcode/(?P<postcode>[A-Za-z0-9 +]+)/uprns%s$" % format_end,
+        postcode_uprns,
+        name="mapit_labour-postcode_uprns",
+    ),
+    re_path(
+        r"^point/(?P<srid>[0-9]+)/(?P<x>%s),(?P<y>%s)/uprns%s$"
+        % (number, number, format_end),
+        point_uprns,
+        name="mapit_labour-point_uprns",
+    ),
     path("addressbase", addressbase, name="mapit_labour-addressbase"),
+    path(
+        "addressbase/autocomplete",
+        autocomplete,
+        name="mapit_labour-autocomplete",
+    ),
     path("import/csv", import_csv, name="mapit_labour-import_csv"),
     re_path(
         r"^import/csv/(?P<task_id>[0-9a-f]+)$",
@@ -22,6 +45,11 @@ urlpatterns = [
         name="mapit_labour-import_csv_status",
     ),
     path("health", health_check),
+    re_path(
+        r"^area/(?P<area_id>[0-9]+)/uprns(?:\.(?P<format>ndjson|csv))?$",
+        area_uprns,
+        name="mapit_labour-area_uprns",
+    ),
     # Override the existing mapit.views.areas.area view with our own that
     # supports lookup of branches/regions by GSS code. Necessary because
     # the pseudo-GSS codes assigned to these areas don't match the
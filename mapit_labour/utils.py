@@ -0,0 +1,10 @@
+from itertools import islice
+
+
+def batched(iterable, size):
+    """
+    Split an iterable into lists no bigger than size
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
@@ -1,93 +1,277 @@
+import base64
+import csv
+import hashlib
+import io
 import itertools
+import json
+import re
+from datetime import date, datetime, time, timezone
 from logging import getLogger
 from pprint import pformat
 
-from django.http.response import HttpResponse, HttpResponseRedirect
+from django.http.response import (
+    HttpResponse,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.cache import add_never_cache_headers
 from django.urls import reverse
 from django.http import Http404
-from django.views.decorators.cache import never_cache
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.http import condition, require_POST
+from django.contrib.gis.db.models.functions import GeometryDistance
+from django.contrib.postgres.search import TrigramDistance
+from django.contrib.gis.geos import Point
 
 from django_q.tasks import fetch
 from django_q.models import OrmQ
 
-from mapit.shortcuts import output_json, get_object_or_404
+from mapit.shortcuts import get_object_or_404
 from mapit.models import Generation, Area
 from mapit.views.postcodes import add_codes, enclosing_areas
 from mapit.middleware import ViewException
 from mapit.views.areas import area as mapit_area
 
-from .models import UPRN, CSVImportTaskProgress
+from .cache import (
+    ADDRESSBASE_VERSION_KEY,
+    GLOBAL_VERSION_KEY,
+    UPRN_VERSION_KEY,
+    AreaCache,
+    autocomplete_key,
+    cache_response,
+    get_cached_response,
+    get_versions,
+    query_hash,
+    token_time,
+    uprn_response_key,
+)
+from .addressbase import FIELDS as ADDRESSBASE_FIELDS
+from .shortcuts import SplicingJSONEncoder, output_json
+from .models import (
+    ADDRESS_C,
+    POSTCODE_C,
+    UPRN,
+    UPRNAssignment,
+    CSVImportTaskProgress,
+    X,
+    Y,
+    addressbase_columns,
+)
+from .utils import batched
 from .forms import ImportCSVForm
 
 logger = getLogger(__name__)
 
-# valid field names for AddressBase Core lookups
-FIELD_NAMES = [
-    "parent_uprn",
-    "uprn",
-    "udprn",
-    "usrn",
-    "toid",
-    "classification_code",
-    "easting",
-    "northing",
-    "latitude",
-    "longitude",
-    "rpc",
-    "last_update_date",
-    "po_box",
-    "organisation",
-    "sub_building",
-    "building_name",
-    "building_number",
-    "street_name",
-    "locality",
-    "town_name",
-    "post_town",
-    "island",
-    "postcode",
-    "delivery_point_suffix",
-    "gss_code",
-    "change_code",
-    # This does appear in the AddressBase Core record but is
-    # queried in a different way so isn't included in this list.
-    # "single_line_address",
-]
+# valid field names for AddressBase Core lookups. single_line_address does
+# appear in the AddressBase Core record but is queried in a different way
+# so isn't included in this list.
+FIELD_NAMES = [f for f in ADDRESSBASE_FIELDS if f != "single_line_address"]
 
+# AddressBase values are upper case, except for TOIDs ("osgb…"), so lookup
+# values are converted to match
+LOOKUP_CASE = {"toid": str.lower}
 
-@never_cache
-def uprn(request, uprn, format="json"):
-    uprn = get_object_or_404(UPRN, format=format, uprn=uprn)
 
-    query = Generation.objects.query_args(request, format)
-    areas = list(add_codes(Area.objects.by_location(uprn.location, query)))
+def get_addressbase_fields(request):
+    """
+    The AddressBase fields listed in the fields parameter, or None to
+    return whole AddressBase records.
+    """
+    if not (fields := request.GET.get("fields")):
+        return None
+    fields = [f.strip().lower() for f in fields.split(",") if f.strip()]
+    if invalid := [f for f in fields if f not in ADDRESSBASE_FIELDS]:
+        raise ViewException("json", f"Unknown fields: {', '.join(invalid)}", 400)
+    return fields
+
 
+def get_shortcuts(areas):
+    """Shortcuts to the most useful of the given serialised areas."""
     shortcuts = {}
     for area in areas:
-        if area.type.code in ("COP", "LBW", "LGE", "MTW", "UTE", "UTW"):
-            shortcuts["ward"] = area.id
-            shortcuts["council"] = area.parent_area_id
-        elif area.type.code == "CED":
-            shortcuts.setdefault("ward", {})["county"] = area.id
-            shortcuts.setdefault("council", {})["county"] = area.parent_area_id
-        elif area.type.code == "DIW":
-            shortcuts.setdefault("ward", {})["district"] = area.id
-            shortcuts.setdefault("council", {})["district"] = area.parent_area_id
-        elif area.type.code in ("WMC",):
+        if area["type"] in ("COP", "LBW", "LGE", "MTW", "UTE", "UTW"):
+            shortcuts["ward"] = area["id"]
+            shortcuts["council"] = area["parent_area"]
+        elif area["type"] == "CED":
+            shortcuts.setdefault("ward", {})["county"] = area["id"]
+            shortcuts.setdefault("council", {})["county"] = area["parent_area"]
+        elif area["type"] == "DIW":
+            shortcuts.setdefault("ward", {})["district"] = area["id"]
+            shortcuts.setdefault("council", {})["district"] = area["parent_area"]
+        elif area["type"] in ("WMC",):
             # XXX Also maybe 'EUR', 'NIE', 'SPC', 'SPE', 'WAC', 'WAE', 'OLF', 'OLG', 'OMF', 'OMG'):
-            shortcuts[area.type.code] = area.id
+            shortcuts[area["type"]] = area["id"]
+    return shortcuts
 
-    # Add manual enclosing areas.
+
+def get_enclosing_area_ids(type_codes):
+    """Manual enclosing areas for areas of the given types, as per MapIt's postcode view."""
     extra = []
-    for area in areas:
-        if area.type.code in enclosing_areas.keys():
-            extra.extend(enclosing_areas[area.type.code])
-    areas = itertools.chain(areas, Area.objects.filter(id__in=extra))
+    for code in type_codes:
+        if code in enclosing_areas.keys():
+            extra.extend(enclosing_areas[code])
+    return extra
+
+
+def current_generation_id(request):
+    """
+    The ID of the current generation, or 0 if there isn't one. Memoised on
+    the request, as it's needed by the validators as well as the view.
+    """
+    if not hasattr(request, "_current_generation_id"):
+        current = Generation.objects.current()
+        request._current_generation_id = current.id if current else 0
+    return request._current_generation_id
+
+
+def get_uprn_versions(request, uprn):
+    """The global and UPRN version tokens for a UPRN lookup, memoised on the request."""
+    if not hasattr(request, "_uprn_versions"):
+        request._uprn_versions = get_versions(
+            GLOBAL_VERSION_KEY, UPRN_VERSION_KEY % int(uprn)
+        )
+    return request._uprn_versions
+
+
+def get_assignment_generation(request):
+    """
+    Return the ID of the generation whose precomputed UPRN assignments can
+    answer this request, or None if they can't be used (e.g. when the
+    request spans several generations with min_generation).
+    Should be called after Generation.objects.query_args has validated
+    the query parameters.
+    """
+    if "min_generation" in request.GET:
+        return None
+    return (
+        int(request.GET.get("generation") or 0)
+        or current_generation_id(request)
+        or None
+    )
+
+
+def get_area_ids(request, query, uprns):
+    """
+    Return a dict mapping each of the given UPRN IDs to the IDs of the areas
+    matching query that contain it, from the precomputed assignments where
+    possible and a spatial join for the rest.
+    """
+    area_ids = {}
+    if generation := get_assignment_generation(request):
+        area_ids = UPRNAssignment.objects.area_ids(uprns, generation)
+        if area_ids and ("type" in request.GET or "country" in request.GET):
+            # Assignments cover every area in the generation
+            allowed = set(
+                Area.objects.filter(
+                    query, id__in=set(itertools.chain.from_iterable(area_ids.values()))
+                ).values_list("id", flat=True)
+            )
+            area_ids = {
+                uprn: [id for id in ids if id in allowed]
+                for uprn, ids in area_ids.items()
+            }
+    if missing := [uprn for uprn in uprns if uprn not in area_ids]:
+        area_ids.update(UPRN.objects.area_ids(missing, query))
+    return area_ids
+
+
+def get_area_cache():
+    """A cache of serialised areas for use while handling one request."""
+    return AreaCache(lambda ids: add_codes(Area.objects.filter(id__in=ids)))
+
+
+def get_areas_and_shortcuts(area_cache, area_ids):
+    """
+    Return a dict of serialised areas, including any manual enclosing areas,
+    and the shortcuts for the areas with the given IDs. The areas are in
+    Area's default ordering, followed by the enclosing areas, as
+    Area.objects.by_location would return them.
+    """
+    areas = area_cache.get_many(area_ids)
+    shortcuts = get_shortcuts(areas)
+    areas.extend(
+        area_cache.get_many(get_enclosing_area_ids(area["type"] for area in areas))
+    )
+    return {area["id"]: area for area in areas}, shortcuts
+
+
+def get_uprn_validators(request, uprn, format="json"):
+    """
+    Return the (ETag, Last-Modified) validators for a UPRN lookup, or
+    (None, None) if the UPRN doesn't exist. These only need a primary key
+    lookup and the cache version tokens, so a conditional request can be
+    answered without any spatial queries. Memoised on the request, as
+    condition() asks for each validator separately.
+    """
+    if not hasattr(request, "_uprn_validators"):
+        request._uprn_validators = (None, None)
+        found = UPRN.objects.filter(uprn=uprn).values_list("last_update_date").first()
+        if found is not None:
+            last_update = found[0] or date.min
+            global_version, uprn_version = get_uprn_versions(request, uprn)
+            state = [
+                uprn,
+                last_update,
+                current_generation_id(request),
+                global_version,
+                uprn_version,
+                query_hash(request),
+                format,
+            ]
+            if format == "html":
+                # The HTML version includes the user's API key
+                state.append(request.user.id)
+            request._uprn_validators = (
+                hashlib.md5(repr(state).encode()).hexdigest(),
+                max(
+                    datetime.combine(last_update, time.min, tzinfo=timezone.utc),
+                    token_time(global_version),
+                    token_time(uprn_version),
+                ),
+            )
+    return request._uprn_validators
+
+
+def uprn_etag(request, uprn, format="json"):
+    return get_uprn_validators(request, uprn, format)[0]
+
+
+def uprn_last_modified(request, uprn, format="json"):
+    return get_uprn_validators(request, uprn, format)[1]
+
+
+@cache_control(max_age=0, no_cache=True, must_revalidate=True, private=True)
+@condition(etag_func=uprn_etag, last_modified_func=uprn_last_modified)
+def uprn(request, uprn, format="json"):
+    # The HTML version includes the user's API key so can't be shared
+    cache_key = None
+    generation = current_generation_id(request)
+    if format != "html":
+        cache_key = uprn_response_key(
+            request, int(uprn), generation, get_uprn_versions(request, int(uprn))
+        )
+        if response := get_cached_response(cache_key):
+            return response
+
+    fields = get_addressbase_fields(request)
+    # The JSON output includes the record as PostgreSQL encoded it
+    uprns = UPRN.objects.filter(uprn=uprn).rows(fields, raw=format != "html")
+    uprn = next(uprns, None)
+    if uprn is None:
+        raise ViewException(format, "No UPRN matches the given query.", 404)
+
+    query = Generation.objects.query_args(request, format)
+    area_ids = get_area_ids(request, query, [uprn.uprn]).get(uprn.uprn, [])
 
     if format == "html":
+        areas = list(add_codes(Area.objects.filter(id__in=area_ids)))
+        # Add manual enclosing areas.
+        extra = get_enclosing_area_ids(area.type.code for area in areas)
+        areas = itertools.chain(areas, Area.objects.filter(id__in=extra))
+
         api_key = None
         if key := request.user.api_key.first():
             api_key = key.key
@@ -103,35 +287,417 @@ def uprn(request, uprn, format="json"):
         )
 
     out = uprn.as_dict()
-    out["areas"] = dict((area.id, area.as_dict()) for area in areas)
+    out["areas"], shortcuts = get_areas_and_shortcuts(get_area_cache(), area_ids)
 
     if shortcuts:
         out["shortcuts"] = shortcuts
+    return cache_response(cache_key, output_json(out))
+
+
+def get_requested_uprns(request):
+    """
+    Parse the list of UPRNs from the body of a batch lookup request, either
+    a JSON list (or an object with a "uprns" list) or a form-encoded "uprns"
+    field of comma-separated values.
+    """
+    try:
+        if request.content_type == "application/json":
+            uprns = json.loads(request.body)
+            if isinstance(uprns, dict):
+                uprns = uprns.get("uprns", [])
+        else:
+            uprns = [
+                u for v in request.POST.getlist("uprns") for u in v.split(",") if u
+            ]
+        if not isinstance(uprns, list):
+            raise ValueError
+        uprns = [int(u) for u in uprns]
+    except (ValueError, TypeError):
+        raise ViewException(
+            "json", "UPRNs must be provided as a list of integers.", 400
+        )
+
+    if not uprns:
+        raise ViewException("json", "At least one UPRN should be specified.", 400)
+    if len(uprns) > settings.UPRN_BATCH_LIMIT:
+        raise ViewException(
+            "json",
+            f"No more than {settings.UPRN_BATCH_LIMIT} UPRNs can be looked up at once.",
+            400,
+        )
+    return uprns
+
+
+@require_POST
+@never_cache
+def uprns(request):
+    """
+    Batch version of the uprn view. Takes a list of UPRNs and returns a dict
+    of UPRN to the same data the uprn view returns for each one that exists.
+    The number of database queries is constant regardless of how many UPRNs
+    are requested.
+    """
+    requested = get_requested_uprns(request)
+    query = Generation.objects.query_args(request, "json")
+
+    uprns = list(
+        UPRN.objects.filter(uprn__in=requested).rows(
+            get_addressbase_fields(request), raw=True
+        )
+    )
+    area_ids = get_area_ids(request, query, [uprn.uprn for uprn in uprns])
+
+    # Load all the areas needed for the whole batch in one go, so the number
+    # of queries doesn't grow with the batch size.
+    area_cache = get_area_cache()
+    areas = area_cache.get_many(set(itertools.chain.from_iterable(area_ids.values())))
+    area_cache.get_many(set(get_enclosing_area_ids(area["type"] for area in areas)))
+
+    out = {}
+    for uprn in uprns:
+        d = uprn.as_dict()
+        d["areas"], shortcuts = get_areas_and_shortcuts(
+            area_cache, area_ids.get(uprn.uprn, [])
+        )
+        if shortcuts:
+            d["shortcuts"] = shortcuts
+        out[uprn.uprn] = d
+    return output_json(out)
+
+
+def postcode_uprns(request, postcode, format="json"):
+    """
+    List the UPRNs in a postcode, optionally with the IDs of the areas each
+    one is in (and their shortcuts) if the areas parameter is given.
+    """
+    postcode = re.sub(r"[\s+]", "", postcode).upper()
+    uprns = UPRN.objects.filter(postcode=postcode)
+
+    if format == "html":
+        return render(request, "mapit_labour/uprns.html", {"uprns": uprns})
+
+    uprns = list(uprns.rows(get_addressbase_fields(request), raw=True))
+    out = [uprn.as_dict() for uprn in uprns]
+    if request.GET.get("areas"):
+        query = Generation.objects.query_args(request, format)
+        area_ids = get_area_ids(request, query, [uprn.uprn for uprn in uprns])
+        area_cache = get_area_cache()
+        for d in out:
+            areas = area_cache.get_many(area_ids.get(d["uprn"], []))
+            d["areas"] = [area["id"] for area in areas]
+            if shortcuts := get_shortcuts(areas):
+                d["shortcuts"] = shortcuts
     return output_json(out)
 
 
+# Columns of the CSV output of area_uprns
+AREA_UPRNS_CSV_FIELDS = [
+    "uprn",
+    "postcode",
+    "easting",
+    "northing",
+    "wgs84_lon",
+    "wgs84_lat",
+    "single_line_address",
+]
+
+
+def area_uprns(request, area_id, format="ndjson"):
+    """
+    Stream every UPRN within an area, as newline-delimited JSON (one UPRN
+    per line, in the same format as the uprn view without areas) or CSV.
+    Rows are read from a server-side cursor and written out a chunk at a
+    time, so the whole result is never held in memory.
+    """
+    area = get_object_or_404(Area, format="json", id=area_id)
+    uprns = UPRN.objects.within_area(area.id)
+    if format == "csv":
+        rows = (
+            uprns.annotate(easting=X("location"), northing=Y("location"))
+            .values_list(*AREA_UPRNS_CSV_FIELDS)
+            .iterator(chunk_size=settings.STREAMING_CHUNK_SIZE)
+        )
+    else:
+        rows = uprns.rows(chunk_size=settings.STREAMING_CHUNK_SIZE, raw=True)
+    chunks = batched(rows, settings.STREAMING_CHUNK_SIZE)
+
+    if format == "csv":
+        content = stream_area_uprns_csv(chunks)
+        response = StreamingHttpResponse(content, content_type="text/csv")
+        response["Content-Disposition"] = (
+            f'attachment; filename="area-{area.id}-uprns.csv"'
+        )
+    else:
+        content = stream_area_uprns_ndjson(chunks)
+        response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def output_json_stream(items):
+    """
+    Like output_json for a list, but encodes the items a chunk at a time as
+    they're iterated over (e.g. from a server-side cursor) so the whole
+    list is never held in memory. The output is the same as output_json's.
+    """
+    encoder = SplicingJSONEncoder()
+
+    def content():
+        yield "["
+        separator = ""
+        for chunk in batched(items, settings.STREAMING_CHUNK_SIZE):
+            yield separator + ", ".join(map(encoder.encode, chunk))
+            separator = ", "
+        yield "]"
+
+    response = StreamingHttpResponse(
+        content(), content_type="application/json; charset=utf-8"
+    )
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def stream_area_uprns_ndjson(chunks):
+    encoder = SplicingJSONEncoder()
+    for chunk in chunks:
+        yield "".join(encoder.encode(uprn.as_dict()) + "\n" for uprn in chunk)
+
+
+def stream_area_uprns_csv(chunks):
+    f = io.StringIO()
+    w = csv.writer(f)
+    w.writerow(AREA_UPRNS_CSV_FIELDS)
+    for chunk in chunks:
+        w.writerows(chunk)
+        yield f.getvalue()
+        f.seek(0)
+        f.truncate()
+    if f.tell():
+        yield f.getvalue()
+
+
+def point_uprns(request, srid, x, y, format="json"):
+    """
+    The UPRNs nearest to a point, closest first, with their distance from it
+    in metres. Uses a KNN search on the spatial index so is fast however
+    many UPRNs there are.
+    """
+    location = Point(float(x), float(y), srid=int(srid))
+    try:
+        location = location.transform(settings.MAPIT_AREA_SRID, clone=True)
+    except Exception:
+        raise ViewException(format, "Point outside the area geometry", 400)
+
+    try:
+        count = int(request.GET.get("count", settings.NEAREST_UPRNS_DEFAULT))
+    except ValueError:
+        raise ViewException(format, "Bad count specified", 400)
+    count = min(max(count, 1), settings.NEAREST_UPRNS_LIMIT)
+
+    uprns = UPRN.objects.annotate(
+        distance=GeometryDistance("location", location)
+    ).order_by("distance")[:count]
+
+    if format == "html":
+        return render(request, "mapit_labour/uprns.html", {"uprns": uprns})
+
+    out = []
+    for uprn in uprns.with_addressbase_fields(get_addressbase_fields(request)):
+        d = uprn.as_dict()
+        d["distance"] = uprn.distance
+        out.append(d)
+    return output_json(out)
+
+
+def ranked_addressbase(uprns, q, limit, fields=None):
+    """
+    Return the AddressBase records (or just the given fields of them) of
+    the limit UPRNs whose single line addresses are most similar to q, each
+    with a similarity "score" from 0 to 1. The trigram distance ordering is
+    answered by a nearest-neighbour search of the GiST trigram index, so
+    doesn't need to score every match.
+    """
+    columns, to_record = addressbase_columns(fields)
+    uprns = (
+        uprns.filter(single_line_address__trigram_similar=q)
+        .annotate(distance=TrigramDistance("single_line_address", q))
+        .order_by("distance")
+        .values_list("distance", *columns)
+    )
+    out = []
+    for distance, *values in uprns[:limit]:
+        addressbase = to_record(values)
+        addressbase["score"] = round(1 - distance, 4)
+        out.append(addressbase)
+    return out
+
+
+def encode_cursor(uprn):
+    """An opaque pagination token for the results after the given UPRN."""
+    return base64.urlsafe_b64encode(str(uprn).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ViewException("json", "Invalid cursor specified.", 400)
+
+
+def next_page_url(request, cursor):
+    params = request.GET.copy()
+    params["cursor"] = cursor
+    return request.build_absolute_uri(f"{request.path}?{params.urlencode()}")
+
+
+def get_addressbase_validators(request):
+    """
+    Return the (ETag, Last-Modified) validators for an AddressBase search,
+    from the most recent LAST_UPDATE_DATE (an index lookup) and the cache
+    version tokens. Memoised on the request.
+    """
+    if not hasattr(request, "_addressbase_validators"):
+        last_update = UPRN.objects.latest_update_date()
+        global_version, addressbase_version = get_versions(
+            GLOBAL_VERSION_KEY, ADDRESSBASE_VERSION_KEY
+        )
+        state = [last_update, global_version, addressbase_version, query_hash(request)]
+        modified = [token_time(global_version), token_time(addressbase_version)]
+        if last_update:
+            modified.append(
+                datetime.strptime(last_update, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            )
+        request._addressbase_validators = (
+            hashlib.md5(repr(state).encode()).hexdigest(),
+            max(modified),
+        )
+    return request._addressbase_validators
+
+
+def addressbase_etag(request):
+    return get_addressbase_validators(request)[0]
+
+
+def addressbase_last_modified(request):
+    return get_addressbase_validators(request)[1]
+
+
+@condition(etag_func=addressbase_etag, last_modified_func=addressbase_last_modified)
 def addressbase(request):
     lookup = {
-        k.lower(): request.GET[k].upper()
+        k.lower(): LOOKUP_CASE.get(k.lower(), str.upper)(request.GET[k])
         for k in request.GET.keys()
         if k.lower() in FIELD_NAMES
     }
     single_line_address = request.GET.get("single_line_address")
+    q = request.GET.get("q", "").strip()
+    area_id = request.GET.get("area")
 
-    if not lookup and not single_line_address:
+    if not lookup and not single_line_address and not q:
         raise ViewException(
             "json",
             "At least one AddressBase Core field should be specified in the query parameters.",
             400,
         )
 
-    uprns = UPRN.objects.all().values_list("addressbase", flat=True)
-
+    uprns = UPRN.objects.all()
     if lookup:
-        uprns = uprns.filter(addressbase__contains=lookup)
+        uprns = uprns.addressbase_lookup(lookup)
     if single_line_address:
         uprns = uprns.filter(single_line_address__contains=single_line_address.upper())
-    return output_json(list(uprns[: settings.ADDRESSBASE_RESULTS_LIMIT]))
+    if area_id:
+        # In the same query as the other filters, so PostgreSQL can combine
+        # the spatial index with the AddressBase ones
+        if not area_id.isdigit():
+            raise ViewException("json", "Bad area specified.", 400)
+        area = get_object_or_404(Area, format="json", id=area_id)
+        uprns = uprns.within_area(area.id)
+
+    # Fetch only the requested fields of each record if fields is given
+    fields = get_addressbase_fields(request)
+
+    limit = settings.ADDRESSBASE_RESULTS_LIMIT
+    if q:
+        uprns = uprns.with_addressbase_fields(fields)
+        return output_json(ranked_addressbase(uprns, q.upper(), limit, fields))
+
+    # Results are paginated on the primary key rather than with OFFSET, so
+    # each page costs the same however far through the results it is. The
+    # records are output as PostgreSQL encoded them.
+    uprns = uprns.with_addressbase_json(fields)
+    columns, to_record = addressbase_columns(fields, raw=True)
+    uprns = uprns.order_by("uprn").values_list("uprn", *columns)
+    if cursor := request.GET.get("cursor"):
+        uprns = uprns.filter(uprn__gt=decode_cursor(cursor))
+
+    if request.GET.get("stream"):
+        # Whether there's a next page isn't known until the end, after the
+        # headers have been sent, so streamed results aren't paginated
+        rows = uprns[: settings.ADDRESSBASE_STREAMING_RESULTS_LIMIT].iterator(
+            chunk_size=settings.STREAMING_CHUNK_SIZE
+        )
+        return output_json_stream(to_record(values) for _, *values in rows)
+
+    rows = list(uprns[: limit + 1])
+    response = output_json([to_record(values) for _, *values in rows[:limit]])
+    if len(rows) > limit:
+        response["Link"] = '<%s>; rel="next"' % next_page_url(
+            request, encode_cursor(rows[limit - 1][0])
+        )
+    return response
+
+
+# Prefixes of postcodes, as normalised in the postcode column
+POSTCODE_PREFIX = re.compile(r"^[A-Z]{1,2}[0-9]")
+
+
+def get_suggestions(q, limit):
+    """
+    The first limit UPRNs, by address, whose postcode (if q looks like the
+    start of one) or single line address starts with q. Both are prefix
+    lookups answered in order by the "C" collation indexes on those columns
+    (see UPRN.Meta.indexes), so the index scans stop after limit matches
+    rather than PostgreSQL having to sort every match.
+    """
+    uprns = UPRN.objects.annotate(
+        postcode_c=POSTCODE_C, address_c=ADDRESS_C
+    ).values_list("uprn", "single_line_address")
+    suggestions = {}
+    postcode = q.replace(" ", "")
+    if POSTCODE_PREFIX.match(postcode):
+        suggestions.update(
+            uprns.filter(postcode_c__startswith=postcode).order_by(
+                "postcode_c", "uprn"
+            )[:limit]
+        )
+    if len(suggestions) < limit:
+        suggestions.update(
+            uprns.filter(address_c__startswith=q).order_by("address_c", "uprn")[:limit]
+        )
+    suggestions = sorted(suggestions.items(), key=lambda s: (s[1], s[0]))[:limit]
+    return [
+        {"uprn": uprn, "single_line_address": address} for uprn, address in suggestions
+    ]
+
+
+@cache_control(max_age=settings.AUTOCOMPLETE_MAX_AGE)
+def autocomplete(request):
+    """
+    Suggest addresses for type-ahead as q is typed. Suggestions for each
+    prefix are cached until the next AddressBase import, but only briefly
+    by anything downstream, which wouldn't know about imports.
+    """
+    q = re.sub(r"\s+", " ", request.GET.get("q", "")).strip().upper()
+    if len(q) < settings.AUTOCOMPLETE_MIN_LENGTH:
+        return output_json([])
+    limit = settings.AUTOCOMPLETE_LIMIT
+    out = cache.get_or_set(
+        autocomplete_key(q),
+        lambda: get_suggestions(q, limit),
+        settings.AUTOCOMPLETE_CACHE_TIMEOUT,
+    )
+    return output_json(out)
 
 
 def health_check(request):